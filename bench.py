@@ -0,0 +1,219 @@
+# Benchmarks of the codec over synthetic wind grids, from a small coastal
+# request up to a whole ocean basin.
+# $ python bench.py                  # all grids, format version 1
+# $ python bench.py -f 2 -g small -g basin --json baseline.json
+# $ python bench.py --cold-start     # start up time of the decoder
+import argparse
+import contextlib
+import io
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+import codec
+import decoder
+
+
+# name: (latmin, latmax, lonmin, lonmax, resolution, forecast hours)
+# (grids do not cross the Greenwich meridian, where the longitudes read back
+# from the GRIB would wrap around)
+CONST_GRIDS = {
+    'small': (24, 34, -72, -60, 2, [12, 24, 36, 48]),
+    'medium': (20, 40, -70, -40, 1, list(range(0, 73, 6))),
+    'large': (0, 40, -60, -10, 0.5, list(range(0, 121, 6))),
+    'basin': (0, 60, -80, -10, 0.5, list(range(0, 169, 6))),
+}
+
+
+def synthetic_wind(lats, lons, hours, seed=0):
+    """
+    Return u10 and v10 (hour, lat, lon) arrays of a plausible wind field:
+    a few slowly moving waves of a stream function plus some noise, so that
+    the values look like weather rather than like random noise.
+    """
+    rng = np.random.default_rng(seed)
+    la, lo = np.meshgrid(np.radians(lats), np.radians(lons), indexing='ij')
+    waves = [ (rng.uniform(1, 6), rng.uniform(1, 6), rng.uniform(0, 2*np.pi), rng.uniform(-0.05, 0.05), rng.uniform(2, 8))
+              for _ in range(4) ]
+    u10 = np.empty((len(hours),) + la.shape)
+    v10 = np.empty((len(hours),) + la.shape)
+    for h, hour in enumerate(hours):
+        psi = sum(a * np.sin(kx * lo + ky * la + phase + w * hour) for kx, ky, phase, w, a in waves)
+        u10[h] = 5 + np.gradient(psi, axis=0) * 8 + rng.normal(0, 0.3, la.shape)
+        v10[h] = -np.gradient(psi, axis=1) * 8 + rng.normal(0, 0.3, la.shape)
+    return u10, v10
+
+
+def write_synthetic_grib(grib_file, grid, seed=0):
+    """
+    Write a GRIB file of synthetic wind for the given grid (see CONST_GRIDS).
+    """
+    latmin, latmax, lonmin, lonmax, res, hours = grid
+    lats = np.arange(latmin, latmax + res/2, res)
+    lons = np.arange(lonmin, lonmax + res/2, res)
+    u10, v10 = synthetic_wind(lats, lons, hours, seed)
+    messages = decoder.grib_messages(u10, v10, hours, '2023-08-30', '12:00:00', lats, lons)
+    with open(grib_file, 'wb') as f:
+        f.write(b''.join(messages))
+    return len(hours) * len(lats) * len(lons)
+
+
+def measure(func, repeat):
+    """
+    Run func repeat times and return the result of the last run, the best
+    run time in seconds and the peak of memory allocated during one run
+    (only what's allocated through Python, which includes numpy arrays but
+    not eccodes' own buffers).
+    """
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    # Memory is measured apart since tracing slows everything down:
+    tracemalloc.start()
+    try:
+        result = func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return result, best, peak
+
+
+def bench_grid(name, grid, version, repeat, tmpdir):
+    grib_file = os.path.join(tmpdir, f"{name}.grb")
+    num_values = write_synthetic_grib(grib_file, grid)
+    stats = { 'grid': name, 'version': version, 'values': num_values }
+
+    def run_encode():
+        # Start from a cold payload cache, as for a new forecast:
+        codec.payload_cache.clear()
+        parts = []
+        def send_part(part):
+            parts.append(part)
+            return True
+        assert codec.encode(grib_file, send_part, version=version)
+        return parts
+
+    def run_next_part():
+        # Only build the parts, from an already quantized payload:
+        part_no = 0
+        consumed = 0
+        while consumed < len(payload['symbols']):
+            _part, consumed = codec.next_part(part_no, payload['symbols'], consumed, *payload['header'], 0, version)
+            part_no += 1
+        return part_no
+
+    def run_decode_msg():
+        return [ decoder.decode_msg(encoded, shift, version) for encoded, shift in encoded_parts ]
+
+    def run_decode():
+        with contextlib.redirect_stdout(io.StringIO()):
+            decoder.decode(parts, os.path.join(tmpdir, f"{name}.decoded.grb"))
+
+    payload = codec.encode_payload(grib_file, version)
+    parts, stats['encode_s'], stats['encode_peak'] = measure(run_encode, repeat)
+    stats['parts'] = len(parts)
+    stats['chars'] = sum(len(part) for part in parts)
+    _, stats['next_part_s'], stats['next_part_peak'] = measure(run_next_part, repeat)
+    # What decode_msg is given is the encoded text without the part headers,
+    # and the shift:
+    encoded_parts = []
+    for part_no, part in enumerate(parts):
+        lines = part.split('\n')
+        shift = int(lines[4 if part_no == 0 else 0].split(',')[0 if part_no == 0 else 1])
+        encoded_parts.append((''.join(lines[5 if part_no == 0 else 1:]).removesuffix('END'), shift))
+    _, stats['decode_msg_s'], stats['decode_msg_peak'] = measure(run_decode_msg, repeat)
+    _, stats['decode_s'], stats['decode_peak'] = measure(run_decode, repeat)
+    return stats
+
+
+def cold_start(version, repeat, tmpdir):
+    """
+    Time, in fresh Python processes as on board, the imports of the decoder
+    and of the codec, and the decoding of a small forecast with decode.py.
+    """
+    grib_file = os.path.join(tmpdir, 'cold.grb')
+    write_synthetic_grib(grib_file, CONST_GRIDS['small'])
+    msg_file = os.path.join(tmpdir, 'cold.txt')
+    parts = []
+    def send_part(part):
+        parts.append(part)
+        return True
+    assert codec.encode(grib_file, send_part, version=version)
+    with open(msg_file, 'w') as f:
+        f.write(''.join(parts))
+    here = os.path.dirname(os.path.abspath(__file__))
+    commands = {
+        'python': [ sys.executable, '-c', 'pass' ],
+        'import decoder': [ sys.executable, '-c', 'import decoder' ],
+        'import codec': [ sys.executable, '-c', 'import codec' ],
+        'decode.py': [ sys.executable, os.path.join(here, 'decode.py'), '-o', os.path.join(tmpdir, 'cold.decoded.grb'), msg_file ],
+    }
+    stats = {}
+    for name, command in commands.items():
+        def run():
+            subprocess.run(command, cwd=here, check=True, stdout=subprocess.DEVNULL)
+        # Once first so that the bytecode is compiled and the files cached:
+        run()
+        stats[name] = measure(run, repeat)[1]
+    return stats
+
+
+def print_stats(all_stats):
+    stages = [ 'encode', 'next_part', 'decode_msg', 'decode' ]
+    print(f"{'grid':>8} {'v':>2} {'values':>9} {'parts':>6} " +
+          ' '.join(f"{stage + ' ms':>13} {'peak MB':>8}" for stage in stages))
+    for stats in all_stats:
+        print(f"{stats['grid']:>8} {stats['version']:>2} {stats['values']:>9} {stats['parts']:>6} " +
+              ' '.join(f"{stats[stage + '_s']*1000:>13.1f} {stats[stage + '_peak']/1e6:>8.1f}" for stage in stages))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='Codec benchmarks',
+        description='Time the encoding and decoding of synthetic wind grids')
+    parser.add_argument('-g', '--grid',
+        choices=list(CONST_GRIDS),
+        action='append',
+        help='Grid to benchmark (can be repeated, default: all)')
+    parser.add_argument('-f', '--format-version',
+        type=int,
+        choices=[1, decoder.CONST_FORMAT_VERSION],
+        default=1,
+        help='Format version of the encoded data')
+    parser.add_argument('-r', '--repeat',
+        type=int,
+        default=3,
+        help='Number of runs of each stage, the best one being kept')
+    parser.add_argument('--cold-start',
+        action='store_true',
+        help='Only time the start up of the decoder, in new processes')
+    parser.add_argument('--json',
+        type=str,
+        help='Also save the results into that file, to compare with later runs')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        if args.cold_start:
+            all_stats = cold_start(args.format_version, args.repeat, tmpdir)
+            for name, seconds in all_stats.items():
+                print(f"{name:>15} {seconds*1000:>8.1f} ms")
+        else:
+            all_stats = []
+            for name in args.grid or CONST_GRIDS:
+                all_stats.append(bench_grid(name, CONST_GRIDS[name], args.format_version, args.repeat, tmpdir))
+            print_stats(all_stats)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(all_stats, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
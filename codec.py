@@ -1,131 +1,820 @@
-import os
-import cfgrib  # type: ignore[import-untyped]
+import collections
+import eccodes  # type: ignore[import-untyped]
+import hashlib
+import mmap
 import numpy as np
 import pandas as pd
-import xarray as xr
+import threading
 
-CONST_MAX_SHIFT = 10
-CONST_MAX_MSG_SIZE = 120
+# The format itself, shared with the decoder:
+from decoder import (
+    CONST_CHARS, CONST_CHARS_V2, CONST_CODES_V2, CONST_FORMAT_VERSION,
+    CONST_MAG_STEP, CONST_MAX_MSG_SIZE, CONST_MAX_SHIFT, CONST_NUM_CONTEXTS,
+    CONST_CODER_FULL, CONST_CODER_HALF, CONST_CODER_QUARTER,
+    codes_of_shift, new_freqs, shifts_of_version, update_freqs)
+# Still available from here for the tools using both halves:
+from decoder import decode, decode_msg, grib_messages  # noqa: F401
+
+#
+# Compressed format (version 2), see decoder.py
+#
+
+def wrap_dir(d):
+    """
+    Bring a difference of directions back into -8..7.
+    """
+    return (d + 8) % 16 - 8
+
+
+def med_predict(left, up, upleft):
+    """
+    Median edge detector: pick left or up across an edge, or extrapolate
+    the plane in smooth areas. Works on scalars as well as arrays.
+    """
+    lo = np.minimum(left, up)
+    hi = np.maximum(left, up)
+    return np.where(upleft >= hi, lo, np.where(upleft <= lo, hi, left + up - upleft))
+
+
+def context_of(timestep, left, up):
+    return np.where(timestep > 0, 3, 0) + np.minimum(np.abs(left - up), 2)
 
-# Characters that can (almost) safely be sent via inReach:
-# FIXME: apparently, "Θ" can cause problems. Remove it and add another CONST_EXTRACHARS?
-CONST_CHARS = """!"#$%\'()*+,-./:;<=>?_¡£¥¿&¤0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyzÄÅÆÇÉÑØøÜßÖàäåæèéìñòöùüΔΦΓΛΩΠΨΣΘΞ"""
-# To get a full range of 128 code possibilities, these are extra two character
-# codes:
-CONST_EXTRACHARS = [ '@!', '@@', '@#', '@$', '@%', '@?' ]
 
-assert len(CONST_CHARS) + len(CONST_EXTRACHARS) == 128
+def predict(deltas, timestep):
+    """
+    Predict each change of a (lat, lon) grid of changes since the previous
+    timestep from its left, up and up-left neighbours (0 out of the grid),
+    and return that prediction and the context each value is coded in.
+    """
+    left = np.zeros_like(deltas)
+    left[:, 1:] = deltas[:, :-1]
+    up = np.zeros_like(deltas)
+    up[1:, :] = deltas[:-1, :]
+    upleft = np.zeros_like(deltas)
+    upleft[1:, 1:] = deltas[:-1, :-1]
+    return med_predict(left, up, upleft), context_of(timestep, left, up)
+
+
+def arith_encoder():
+    """
+    Return a function coding the given symbols, each in its own context
+    (first the magnitude contexts then the direction ones, see new_freqs),
+    and returning the new bits that are known so far, and a function
+    returning the last bits once all symbols are coded.
+    """
+    freqs = new_freqs()
+    totals = [ sum(f) for f in freqs ]
+    low, high, pending = 0, CONST_CODER_FULL, 0
+
+    def encode_symbols(contexts, symbols):
+        nonlocal low, high, pending
+        bits = []
+        for ctx, sym in zip(contexts, symbols):
+            f = freqs[ctx]
+            cum = sum(f[:sym])
+            rng = high - low + 1
+            high = low + rng * (cum + f[sym]) // totals[ctx] - 1
+            low = low + rng * cum // totals[ctx]
+            while True:
+                if high < CONST_CODER_HALF:
+                    bits.append(0)
+                    bits.extend([1] * pending)
+                    pending = 0
+                elif low >= CONST_CODER_HALF:
+                    bits.append(1)
+                    bits.extend([0] * pending)
+                    pending = 0
+                    low -= CONST_CODER_HALF
+                    high -= CONST_CODER_HALF
+                elif low >= CONST_CODER_QUARTER and high < 3 * CONST_CODER_QUARTER:
+                    pending += 1
+                    low -= CONST_CODER_QUARTER
+                    high -= CONST_CODER_QUARTER
+                else:
+                    break
+                low <<= 1
+                high = (high << 1) | 1
+            update_freqs(freqs, totals, ctx, sym)
+        return bits
+
+    def finish():
+        # Enough bits to tell in which quarter low is:
+        if low < CONST_CODER_QUARTER:
+            return [0] + [1] * (pending + 1)
+        else:
+            return [1] + [0] * (pending + 1)
+
+    return encode_symbols, finish
+
+
+def compress_steps(steps):
+    """
+    Code the (lat, lon) arrays of quantized magnitudes and directions of
+    each timestep in turn, yielding the bits known after each of them, and
+    then the last bits.
+    """
+    encode_symbols, finish = arith_encoder()
+    prev_mag = None
+    for t, (mag, dirs) in enumerate(steps):
+        if prev_mag is None:
+            prev_mag = np.zeros(mag.shape, dtype=int)
+            prev_dir = np.zeros(mag.shape, dtype=int)
+        # Magnitudes:
+        pred, mag_ctx = predict(mag - prev_mag, t)
+        expected = np.clip(prev_mag + pred, 0, 15)
+        mag_residuals = (mag - expected).ravel() + 15
+        # Directions, only where there is some wind:
+        windy = mag > 0
+        cur_dir = np.where(windy, dirs, prev_dir)
+        pred, dir_ctx = predict(wrap_dir(cur_dir - prev_dir), t)
+        expected = (prev_dir + pred) % 16
+        contexts = np.concatenate((mag_ctx.ravel(), CONST_NUM_CONTEXTS + dir_ctx[windy]))
+        symbols = np.concatenate((mag_residuals, (cur_dir - expected)[windy] % 16))
+        yield encode_symbols(contexts.tolist(), symbols.tolist())
+        prev_mag = mag
+        prev_dir = cur_dir
+    yield finish()
+
+
+def compress(mag, dirs):
+    """
+    Code the (time, lat, lon) arrays of quantized magnitudes and directions
+    into a list of bits.
+    """
+    return [ bit for bits in compress_steps(zip(mag, dirs)) for bit in bits ]
 
-def chars_of_shift(shift):
-    return CONST_CHARS[shift:] + CONST_CHARS[:shift]
 
 #
 # Encoder
 #
 
-def next_part(part_no, bin_data, consumed, timepoints, latmin, latmax, lonmin, lonmax, latdiff, londiff, gribtime, shift):
-    # This function encodes the GRIB binary data into characters that can be
-    # sent over the inReach.
-    new_chars = chars_of_shift(shift)
-
-    def encoder(x):
-        # This encodes a byte into the coding scheme based on the SHIFT.
-        if len(x) < 7:
-            x = x + '0'*(7-len(x))
-        dec = int(x, 2)
-        if dec < len(CONST_CHARS):
-            return new_chars[dec]
-        else:
-            return CONST_EXTRACHARS[dec - len(CONST_CHARS)]
+# Weights to turn 7 bits (MSB first) into a symbol number:
+CONST_SYMBOL_WEIGHTS = 1 << np.arange(6, -1, -1)
+
+def pack_bits(bits):
+    """
+    Pack an array of bits into an array of 7 bits symbols, MSB first. The
+    last symbol is padded with zeros.
+    """
+    bits = np.asarray(bits, dtype=np.uint8)
+    padding = -len(bits) % 7
+    if padding:
+        bits = np.concatenate((bits, np.zeros(padding, dtype=np.uint8)))
+    return (bits.reshape(-1, 7) @ CONST_SYMBOL_WEIGHTS).astype(np.uint8)
+
+
+def nibble_bits(nibbles):
+    """
+    Turn an array of 4 bits values into an array of bits, MSB first.
+    """
+    return np.unpackbits(np.asarray(nibbles, dtype=np.uint8).reshape(-1, 1), axis=1)[:, 4:].ravel()
+
+
+def pack_nibbles(nibbles):
+    """
+    Pack an array of 4 bits values into an array of 7 bits symbols.
+    The nibbles are concatenated MSB first, and the last symbol is padded
+    with zeros, exactly like the former '0'/'1' string did.
+    """
+    return pack_bits(nibble_bits(nibbles))
+
+
+def pack_chunks(chunks):
+    """
+    Same as pack_bits, but for bits coming in successive chunks: yield the
+    symbols as soon as their 7 bits are known.
+    """
+    left = np.zeros(0, dtype=np.uint8)
+    for bits in chunks:
+        bits = np.concatenate((left, np.asarray(bits, dtype=np.uint8)))
+        complete = len(bits) - len(bits) % 7
+        left = bits[complete:]
+        yield pack_bits(bits[:complete])
+    yield pack_bits(left)
+
+
+def symbols_width(symbols, shift=0, version=1):
+    """
+    How many characters each symbol takes once encoded with that shift (an
+    array of shifts gives one row of widths per shift).
+    """
+    if version == 1:
+        return np.where(symbols < len(CONST_CHARS), 1, 2)
+    codes = (symbols + np.reshape(shift, np.shape(shift) + (1,) * np.ndim(symbols))) % len(CONST_CODES_V2)
+    return np.where(codes < len(CONST_CHARS_V2), 1, 2)
+
 
-    part = ''
-    # First the global header:
+def part_header(part_no, timepoints, latmin, latmax, lonmin, lonmax, latdiff, londiff, gribtime, shift, version=1, mag_step=CONST_MAG_STEP):
+    # First the global header (the format version is appended to the shift
+    # from version 2 onward, and then the step of the magnitudes if not the
+    # usual one):
     if part_no == 0:
         hours = ",".join((timepoints/np.timedelta64(1, 'h')).astype('int').astype('str'))
-        part += f"""{hours}
+        shift_line = f"{shift}" if version == 1 and mag_step == CONST_MAG_STEP else f"{shift},{version}"
+        if mag_step != CONST_MAG_STEP:
+            shift_line += f",{mag_step}"
+        return f"""{hours}
 {gribtime}
 {latmin},{latmax},{lonmin},{lonmax}
 {latdiff},{londiff}
-{shift}
+{shift_line}
 """
     else:
-        part += f"{part_no},{shift}\n"
-    # Then some vector values:
-    while len(part) < CONST_MAX_MSG_SIZE and consumed < len(bin_data):
-        byte = bin_data[consumed:consumed+7]
-        part += encoder(byte)
-        consumed += 7
+        return f"{part_no},{shift}\n"
+
+
+def shift_capacities(part_no, symbols, consumed, timepoints, latmin, latmax, lonmin, lonmax, latdiff, londiff, gribtime, version=1, mag_step=CONST_MAG_STEP):
+    """
+    Return how many symbols next_part would put in that part with each of
+    the shifts of that version.
+    """
+    shifts = np.array(shifts_of_version(version))
+    # Only the number of digits of the shift changes the size of the header:
+    header_size = len(part_header(part_no, timepoints, latmin, latmax, lonmin, lonmax, latdiff, londiff, gribtime, 0, version, mag_step))
+    room = CONST_MAX_MSG_SIZE - header_size - (np.char.str_len(shifts.astype(str)) - 1)
+    remaining = symbols[consumed:consumed + CONST_MAX_MSG_SIZE]
+    widths = symbols_width(remaining, shifts, version)
+    return ((np.cumsum(widths, axis=1) - widths) < room[:, None]).sum(axis=1)
+
+
+def next_part(part_no, symbols, consumed, timepoints, latmin, latmax, lonmin, lonmax, latdiff, londiff, gribtime, shift, version=1, mag_step=CONST_MAG_STEP):
+    # This function encodes the 7 bits symbols into characters that can be
+    # sent over the inReach.
+    alphabet = codes_of_shift(shift, version)
+
+    part = part_header(part_no, timepoints, latmin, latmax, lonmin, lonmax, latdiff, londiff, gribtime, shift, version, mag_step)
+    # Then some vector values, as long as the part is shorter than
+    # CONST_MAX_MSG_SIZE before adding the next symbol:
+    remaining = symbols[consumed:consumed + CONST_MAX_MSG_SIZE]
+    widths = np.cumsum(symbols_width(remaining, shift, version)) - symbols_width(remaining, shift, version)
+    num_symbols = int(np.searchsorted(widths, CONST_MAX_MSG_SIZE - len(part)))
+    part += ''.join([ alphabet[s] for s in remaining[:num_symbols] ])
+    consumed += num_symbols
     part += "\n"
-    if consumed >= len(bin_data):
+    if consumed >= len(symbols):
         part += "END"
     return part, consumed
 
 
-def to_binary_byte(x):
-    return "{0:04b}".format(x)
+#
+# Forbidden sequences
+#
+# Garmin refuses to send some (unknown) pairs of characters. We learn them
+# from the sends: every pair of characters of a part that went through is
+# known good, and every failed part must contain at least one bad pair among
+# its remaining ones. The suspicion of a failure is evenly split amongst
+# those remaining pairs.
+#
+
+CONST_MAX_FAILURES = 200
+
+def new_bigram_model():
+    # The lock allows several transmissions to share the same model:
+    return { 'good': set(), 'failures': [], 'lock': threading.Lock() }
 
 
-def encode(grib_file, send_part):
+def bigrams(part):
+    return { part[i:i+2] for i in range(len(part) - 1) }
+
+
+def learn_from_send(model, part, shift, success):
     """
-    Encode the given GRIB file into fragments suitable to be sent via SMS.
-    send_part is given each fragment in turn, and should return False if the
-    send fails, in which case the fragment will be retried with a different
-    encoding (shift).
+    Update the model with the outcome of sending that part.
+    """
+    with model['lock']:
+        if success:
+            model['good'] |= bigrams(part)
+        else:
+            model['failures'].append({ 'part': part, 'shift': shift })
+            del model['failures'][:-CONST_MAX_FAILURES]
 
-    Returns True if the message could be sent.
+
+def suspicions(model):
+    """
+    Return how much each pair of characters is suspected to be rejected.
+    """
+    scores = {}
+    for failure in model['failures']:
+        suspects = bigrams(failure['part']) - model['good']
+        for bigram in suspects:
+            scores[bigram] = scores.get(bigram, 0) + 1 / len(suspects)
+    return scores
+
+
+def best_shift(model, make_part, candidates):
+    """
+    Among the candidate shifts, in order of preference, return the one which
+    part, as built by make_part, is the least suspicious (first one on ties).
+    """
+    with model['lock']:
+        scores = suspicions(model)
+    if not scores:
+        return candidates[0]
+    best, best_suspicion = None, None
+    for shift in candidates:
+        suspicion = sum(scores.get(bigram, 0) for bigram in bigrams(make_part(shift)))
+        if best is None or suspicion < best_suspicion:
+            best, best_suspicion = shift, suspicion
+            if suspicion == 0:
+                # Can't do better
+                break
+    return best
+
+
+def read_grib(grib_file):
+    """
+    Return the content of the given GRIB file, or the given GRIB data as is.
+    """
+    if isinstance(grib_file, (bytes, bytearray, mmap.mmap)):
+        return grib_file
+    with open(grib_file, 'rb') as f:
+        # Mapped rather than read, so that only the messages being decoded
+        # are in memory:
+        return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def grib_spans(grib):
+    """
+    Yield the start and end offsets of each message of that GRIB data.
+    """
+    start = grib.find(b'GRIB')
+    while start >= 0:
+        if grib[start + 7] == 1:
+            length = int.from_bytes(grib[start + 4:start + 7], 'big')
+        else:
+            length = int.from_bytes(grib[start + 8:start + 16], 'big')
+        yield start, start + length
+        start = grib.find(b'GRIB', start + length)
+
+
+def grib_values(message, shape):
+    """
+    Decode the values of that GRIB message into a grid of that shape, the
+    missing ones being NaN.
+    """
+    handle = eccodes.codes_new_from_message(message)
+    try:
+        values = eccodes.codes_get_values(handle).astype(np.float32)
+        if eccodes.codes_get(handle, 'bitmapPresent'):
+            values[values == eccodes.codes_get(handle, 'missingValue')] = np.nan
+    finally:
+        eccodes.codes_release(handle)
+    return values.reshape(shape)
+
+
+# The GRIB names of the 10m wind components:
+CONST_WIND_NAMES = ('10u', '10v')
+
+def open_wind(grib_file):
+    """
+    Index the 10m wind components of the given GRIB file (its path, or its
+    content as bytes, as received), returning the axes of the
+    (time, lat, lon) grid and a function returning the u10 and v10 arrays
+    of a given timestep, each one being decoded only when asked for.
+    """
+    grib = read_grib(grib_file)
+    # Per (name, forecast hour), where the message is:
+    spans = {}
+    grid = None
+    for start, end in grib_spans(grib):
+        handle = eccodes.codes_new_from_message(grib[start:end])
+        try:
+            name = eccodes.codes_get(handle, 'shortName')
+            if name not in CONST_WIND_NAMES:
+                continue
+            if grid is None:
+                # Latitudes and longitudes in the order of the values:
+                grid = (eccodes.codes_get_array(handle, 'distinctLatitudes'),
+                        eccodes.codes_get_array(handle, 'distinctLongitudes'),
+                        eccodes.codes_get(handle, 'dataDate'),
+                        eccodes.codes_get(handle, 'dataTime'))
+            spans[(name, eccodes.codes_get(handle, 'step'))] = (start, end)
+        finally:
+            eccodes.codes_release(handle)
+    assert grid is not None, "No 10m wind in that GRIB"
+    lats, lons, data_date, data_time = grid
+    hours = sorted({ hour for _, hour in spans })
+    timepoints = np.array(hours, dtype='timedelta64[h]').astype('timedelta64[ns]')
+    gribtime = pd.Timestamp(str(data_date)) + pd.Timedelta(hours=data_time // 100, minutes=data_time % 100)
+
+    def read_step(t):
+        return tuple(
+            grib_values(grib[slice(*spans[(name, hours[t])])], (len(lats), len(lons)))
+            for name in CONST_WIND_NAMES)
+
+    return timepoints, lats, lons, gribtime, read_step
+
+
+def read_wind(grib_file):
+    """
+    Read only the 10m wind components of the given GRIB file, as plain
+    (time, lat, lon) arrays, and the axes of that grid.
+    """
+    timepoints, lats, lons, gribtime, read_step = open_wind(grib_file)
+    steps = [ read_step(t) for t in range(len(timepoints)) ]
+    return timepoints, lats, lons, gribtime, np.stack([ u10 for u10, _ in steps ]), np.stack([ v10 for _, v10 in steps ])
+
+
+def read_run_time(grib_file):
+    """
+    Return the time of the model run this GRIB file comes from.
+    """
+    return open_wind(grib_file)[3]
+
+
+# How far (in degrees) from the requested area a point can be, as the grid
+# sent by Saildocs is sometimes slightly off:
+CONST_GRID_TOLERANCE = 1e-3
+
+def cut_grib(grib_file, latmin, latmax, lonmin, lonmax, hours):
+    """
+    Cut the 10m wind of the given GRIB file down to the points within those
+    latitudes and longitudes (lonmin being the western one, in degrees east
+    whatever the convention of the file) at those forecast hours, and
+    return the GRIB data of that smaller forecast.
+    """
+    grib = read_grib(grib_file)
+    messages = []
+    for start, end in grib_spans(grib):
+        handle = eccodes.codes_new_from_message(grib[start:end])
+        try:
+            if eccodes.codes_get(handle, 'shortName') not in CONST_WIND_NAMES or eccodes.codes_get(handle, 'step') not in hours:
+                continue
+            lats = eccodes.codes_get_array(handle, 'distinctLatitudes')
+            lons = eccodes.codes_get_array(handle, 'distinctLongitudes')
+            lat_idx = np.flatnonzero((lats >= latmin - CONST_GRID_TOLERANCE) & (lats <= latmax + CONST_GRID_TOLERANCE))
+            lon_idx = np.flatnonzero((lons - lonmin + CONST_GRID_TOLERANCE) % 360 <= lonmax - lonmin + 2 * CONST_GRID_TOLERANCE)
+            assert len(lat_idx) > 0 and len(lon_idx) > 0, "Nothing to cut in that area"
+            # Points in the area are contiguous unless the grid wraps around:
+            assert lon_idx[-1] - lon_idx[0] == len(lon_idx) - 1, "Cannot cut across the edge of the grid"
+            values = eccodes.codes_get_values(handle).reshape(len(lats), len(lons))
+            values = values[lat_idx[0]:lat_idx[-1] + 1, lon_idx[0]:lon_idx[-1] + 1]
+            eccodes.codes_set(handle, 'Ni', len(lon_idx))
+            eccodes.codes_set(handle, 'Nj', len(lat_idx))
+            eccodes.codes_set(handle, 'latitudeOfFirstGridPointInDegrees', float(lats[lat_idx[0]]))
+            eccodes.codes_set(handle, 'latitudeOfLastGridPointInDegrees', float(lats[lat_idx[-1]]))
+            eccodes.codes_set(handle, 'longitudeOfFirstGridPointInDegrees', float(lons[lon_idx[0]]))
+            eccodes.codes_set(handle, 'longitudeOfLastGridPointInDegrees', float(lons[lon_idx[-1]]))
+            eccodes.codes_set_values(handle, values.ravel())
+            messages.append(eccodes.codes_get_message(handle))
+        finally:
+            eccodes.codes_release(handle)
+    assert messages, f"No 10m wind at {hours=} in that GRIB"
+    return b''.join(messages)
+
+
+def quantize(u10, v10, mag_step=CONST_MAG_STEP, num_dirs=16):
+    """
+    Return the quantized magnitudes and directions of the given wind
+    components, the missing ones (NaN) being calm.
+    """
+    # The missing values (see grib_values) are sent as calm, the codes
+    # having no room for them:
+    u10 = np.nan_to_num(u10)
+    v10 = np.nan_to_num(v10)
+    # This grabs the U-component and V-component of wind speed, calculates the
+    # magnitude in kts, rounds to the nearest 5kt (or mag_step) speed.
+    mag = np.round(np.sqrt(u10**2 + v10**2)*1.94384/mag_step).astype('int').clip(max=15)
+    # This encodes the wind direction into 16 cardinal directions (or only
+    # num_dirs of them, still numbered out of 16).
+    dirs = ((np.round(np.arctan2(v10, u10) / (2 * np.pi / num_dirs)) + num_dirs) % num_dirs).astype('int') * (16 // num_dirs)
+    # dirs and mag should be of the same size
+    assert dirs.shape == mag.shape, f"{dirs.shape=} != {mag.shape=}"
+    return mag, dirs
+
+
+# What can be dropped to fit a forecast into fewer parts: a reduction is the
+# step between the latitudes and longitudes sent, the step between the
+# timesteps sent, the step of the magnitudes in knots and the number of
+# directions.
+CONST_FULL_REDUCTION = (1, 1, CONST_MAG_STEP, 16)
+CONST_MAX_SPACE_STEP = 4
+CONST_MAX_TIME_STEP = 3
+
+def reductions(version=1, num_lats=None, num_lons=None):
+    """
+    Return the possible reductions, from the one keeping the most values
+    down to the one keeping the fewest, the most precise one first for the
+    same number of values.
+    Given the size of the grid, the space steps that would leave less than
+    2 latitudes or longitudes (hence no increment to tell) are left out.
+    """
+    # Version 1 spends 4 bits on each value whatever its precision:
+    quantizations = [ (CONST_MAG_STEP, 16) ] if version == 1 else [ (CONST_MAG_STEP, 16), (10, 16), (10, 8) ]
+    return sorted(
+        [ (space_step, time_step) + quantization
+          for space_step in range(1, CONST_MAX_SPACE_STEP + 1)
+          if all(num is None or len(range(0, num, space_step)) >= 2 for num in (num_lats, num_lons))
+          for time_step in range(1, CONST_MAX_TIME_STEP + 1)
+          for quantization in quantizations ],
+        key=lambda reduction: (reduction[0]**2 * reduction[1], quantizations.index(reduction[2:])))
+
+
+def nibble_steps(steps):
+    """
+    Turn the quantized magnitudes and directions of each timestep into the
+    bits of version 1: every magnitude then every direction, as 4 bits each.
+    steps is called twice, to go through the timesteps for the magnitudes
+    and then again for the directions, so that only one timestep is in
+    memory at a time.
     """
-    grib = xr.open_dataset(grib_file).to_dataframe()
+    for mag, _ in steps():
+        yield nibble_bits(mag.ravel())
+    for _, dirs in steps():
+        yield nibble_bits(dirs.ravel())
 
-    timepoints = grib.index.get_level_values(0).unique()
-    lats = grib.index.get_level_values(1).unique()
-    lons = grib.index.get_level_values(2).unique()
+
+def open_payload(grib_file, version=1, reduction=CONST_FULL_REDUCTION, stream=False):
+    """
+    Prepare the encoding of the given GRIB file into 7 bits symbols to send,
+    along with what's needed to build the parts (see payload_part).
+    The timesteps are only read, quantized and packed when their symbols
+    are needed (see load_symbols).
+    version is the format of the data: 1 for plain 4 bits values, or 2 for
+    the compressed format (see compress).
+    reduction tells which points, timesteps and precision to send (see
+    reductions).
+    stream tells that the payload is sent only once, the symbols and parts
+    being forgotten as soon as they went through (see drop_symbols), so that
+    the memory needed does not grow with the number of timesteps.
+    """
+    timepoints, lats, lons, gribtime, read_step = open_wind(grib_file)
+    space_step, time_step, mag_step, num_dirs = reduction
+    timepoints = timepoints[::time_step]
+    lats = lats[::space_step]
+    lons = lons[::space_step]
     latmin = lats.min()
     latmax = lats.max()
     lonmin = lons.min()
     lonmax = lons.max()
 
     # This is the difference between each lat/lon point.
-    latdiff = pd.Series(lats).diff().dropna().round(6).unique()
-    londiff = pd.Series(lons).diff().dropna().round(6).unique()
+    latdiff = pd.unique(np.diff(lats).round(6))
+    londiff = pd.unique(np.diff(lons).round(6))
 
     if len(latdiff) > 1 or len(londiff) > 1:
         print('Irregular point separations!')
 
-    gribtime = grib['time'].iloc[0]
+    def steps():
+        for t in range(len(timepoints)):
+            u10, v10 = read_step(t * time_step)
+            yield quantize(u10[::space_step, ::space_step], v10[::space_step, ::space_step], mag_step, num_dirs)
 
-    # This grabs the U-component and V-component of wind speed, calculates the
-    # magnitude in kts, rounds to the nearest 5kt speed, and converts to binary.
-    mag = (np.sqrt(grib['u10']**2 + grib['v10']**2)*1.94384/5).round().astype('int').clip(upper=15).apply(to_binary_byte).str.cat()
-    # This encodes the wind direction into 16 cardinal directions and converts
-    # to binary.
-    dirs = (((round(np.arctan2(grib['v10'], grib['u10']) / (2 * np.pi / 16))) + 16) % 16).astype('int').apply(to_binary_byte).str.cat()
-    # dirs and mag should be of the same size
-    assert len(dirs) == len(mag), f"{len(dirs)=} != {len(mag)=}"
-    # Every number is encoded as binary string of four '0' and '1':
-    assert len(dirs) % 4 == 0
-    assert len(mag) % 4 == 0
+    if version == 1:
+        # Every number is encoded as 4 bits and all those bits are then cut
+        # into 7 bits symbols:
+        chunks = nibble_steps(steps)
+    else:
+        assert version == CONST_FORMAT_VERSION, f"Unknown format {version=}"
+        chunks = compress_steps(steps())
+
+    return {
+        # The symbols loaded so far, but the first 'base' ones when some
+        # were dropped, and the generator of the next ones (None once all
+        # are loaded):
+        'symbols': np.zeros(0, dtype=np.uint8),
+        'base': 0,
+        'chunks': pack_chunks(chunks),
+        'stream': stream,
+        # How many symbols are not needed any more (see drop_symbols):
+        'sent': 0,
+        'lock': threading.Lock(),
+        'header': (timepoints, latmin, latmax, lonmin, lonmax, latdiff[0], londiff[0], gribtime),
+        'version': version,
+        'reduction': reduction,
+        # Parts already built, per (part_no, consumed, shift):
+        'parts': {},
+    }
 
-    # bin_data is a string of 0 and 1 encoding the low-res U/V values
-    bin_data = mag + dirs
 
-    # Due to Garmin's inability to send certain character combinations (such
-    # as ">f" if I recall), this shift attempts to try different encoding schemes.
-    shift = 0
-    part_no = 0
-    consumed = 0
-    while shift <= CONST_MAX_SHIFT and consumed < len(bin_data):
-        part, new_consumed = next_part(part_no, bin_data, consumed, timepoints, latmin, latmax, lonmin, lonmax, latdiff[0], londiff[0], gribtime, shift)
-        # We consume bits by groups of 7:
-        assert new_consumed % 7 == 0, f"{new_consumed=} % 4 != 0, {consumed=}"
-        if send_part(part):
-            # Success
-            part_no += 1
-            shift = 0  # reset shift to 0
-            consumed = new_consumed
+def trim_symbols(payload):
+    # Called with the lock held:
+    num_dropped = min(payload['sent'] - payload['base'], len(payload['symbols']))
+    if num_dropped > 0:
+        payload['symbols'] = payload['symbols'][num_dropped:].copy()
+        payload['base'] += num_dropped
+
+
+def load_symbols(payload, num_symbols):
+    """
+    Make sure that the first num_symbols symbols of the payload (or all of
+    them if there are fewer) are loaded, and return the loaded ones that
+    were not dropped, along with how many were (see drop_symbols).
+    """
+    with payload['lock']:
+        while payload['chunks'] is not None and payload['base'] + len(payload['symbols']) < num_symbols:
+            symbols = next(payload['chunks'], None)
+            if symbols is None:
+                payload['chunks'] = None
+            else:
+                payload['symbols'] = np.concatenate((payload['symbols'], symbols))
+                trim_symbols(payload)
+        return payload['symbols'], payload['base']
+
+
+def drop_symbols(payload, consumed):
+    """
+    Forget the first consumed symbols of a streamed payload, and the parts
+    made of them, as they won't be sent again.
+    """
+    with payload['lock']:
+        payload['sent'] = max(payload['sent'], consumed)
+        trim_symbols(payload)
+        payload['parts'] = { key: part for key, part in payload['parts'].items() if key[1] >= consumed }
+
+
+def encode_payload(grib_file, version=1):
+    """
+    Same as open_payload, but with all the symbols loaded.
+    """
+    payload = open_payload(grib_file, version)
+    load_symbols(payload, float('inf'))
+    return payload
+
+
+def payload_done(payload, consumed):
+    """
+    Tell if all the symbols of the payload have been consumed.
+    """
+    symbols, base = load_symbols(payload, consumed + 1)
+    return consumed >= base + len(symbols)
+
+
+def payload_part(payload, part_no, consumed, shift):
+    """
+    Same as next_part, for the given payload, building each part only once.
+    """
+    key = (part_no, consumed, shift)
+    if key not in payload['parts']:
+        # One more symbol than a part can hold, so that next_part can tell
+        # whether it's the last part:
+        symbols, base = load_symbols(payload, consumed + CONST_MAX_MSG_SIZE + 1)
+        assert consumed >= base, f"Symbols {consumed} and on were dropped"
+        part, new_consumed = next_part(part_no, symbols, consumed - base, *payload['header'], shift, payload['version'], payload['reduction'][2])
+        payload['parts'][key] = (part, base + new_consumed)
+    return payload['parts'][key]
+
+
+# Payloads of the last encoded GRIB files, per content hash, version and
+# reduction, so that each forecast is encoded only once whatever the number
+# of recipients and retries:
+CONST_PAYLOAD_CACHE_SIZE = 16
+payload_cache: collections.OrderedDict = collections.OrderedDict()
+payload_cache_lock = threading.Lock()
+
+def cached_payload(grib_file, version=1, reduction=CONST_FULL_REDUCTION):
+    grib = read_grib(grib_file)
+    key = (hashlib.sha256(grib).hexdigest(), version, reduction)
+    with payload_cache_lock:
+        if key in payload_cache:
+            payload_cache.move_to_end(key)
+        else:
+            payload_cache[key] = open_payload(grib, version, reduction)
+            while len(payload_cache) > CONST_PAYLOAD_CACHE_SIZE:
+                payload_cache.popitem(last=False)
+        return payload_cache[key]
+
+
+def new_progress():
+    # The number of the next part and how many symbols were sent before it:
+    return { 'part_no': 0, 'consumed': 0 }
+
+
+def payload_parts(payload, model, progress=None):
+    """
+    Yield the parts of the given payload, as encode_parts.
+    """
+    version = payload['version']
+    if progress is None:
+        progress = new_progress()
+    if payload['stream']:
+        drop_symbols(payload, progress['consumed'])
+    tried = set()
+    while len(tried) <= CONST_MAX_SHIFT and not payload_done(payload, progress['consumed']):
+        part_no = progress['part_no']
+        consumed = progress['consumed']
+        def make_part(shift):
+            return payload_part(payload, part_no, consumed, shift)
+        candidates = [ shift for shift in shifts_of_version(version) if shift not in tried ]
+        if version > 1:
+            # Prefer the shifts packing the most symbols (lowest shift
+            # first on ties):
+            symbols, base = load_symbols(payload, consumed + CONST_MAX_MSG_SIZE + 1)
+            capacities = shift_capacities(part_no, symbols, consumed - base, *payload['header'], version, payload['reduction'][2])
+            candidates.sort(key=lambda shift: -capacities[shift])
+        shift = best_shift(model, lambda shift: make_part(shift)[0], candidates)
+        part, new_consumed = make_part(shift)
+        success = yield part
+        success = success is None or success
+        learn_from_send(model, part, shift, success)
+        if success:
+            progress['part_no'] = part_no + 1
+            progress['consumed'] = new_consumed
+            tried = set()
+            if payload['stream']:
+                drop_symbols(payload, new_consumed)
         else:
             # Failure, try with another shift:
-            shift += 1
-    return (shift < CONST_MAX_SHIFT)
+            tried.add(shift)
+    return payload_done(payload, progress['consumed'])
+
+
+def count_parts(payload):
+    """
+    Return in how many parts that payload is sent when they all go through.
+    """
+    if 'num_parts' not in payload:
+        payload['num_parts'] = sum(1 for _ in payload_parts(payload, new_bigram_model()))
+    return payload['num_parts']
+
+
+def stream_payload(grib_file, version=1, reduction=CONST_FULL_REDUCTION):
+    return open_payload(grib_file, version, reduction, stream=True)
+
+
+def budget_payload(grib_file, version=1, max_parts=None, stream=False):
+    """
+    Return the cached payload of the given GRIB file with the first
+    reduction (see reductions) that fits in max_parts parts, or the most
+    reduced one if none does.
+    With stream, a new streamed payload is returned instead (see
+    open_payload), the parts of each reduction being counted by encoding it
+    as a stream too.
+    """
+    payload_of = stream_payload if stream else cached_payload
+    if max_parts is None:
+        return payload_of(grib_file, version)
+    _, lats, lons, _, _ = open_wind(grib_file)
+    # Parts of the whole grid per quantization, from which the reductions
+    # that can't possibly fit are skipped without encoding them:
+    full_parts = {}
+    for reduction in reductions(version, len(lats), len(lons)):
+        space_step, time_step, *quantization = reduction
+        quantization = tuple(quantization)
+        if quantization not in full_parts:
+            full_parts[quantization] = count_parts(payload_of(grib_file, version, (1, 1) + quantization))
+        # Fewer values compress a bit worse, so this is a lower bound:
+        if full_parts[quantization] / (space_step**2 * time_step) > max_parts:
+            continue
+        if count_parts(payload_of(grib_file, version, reduction)) <= max_parts:
+            return payload_of(grib_file, version, reduction)
+    print(f"Cannot fit the forecast into {max_parts} parts, sending {count_parts(payload_of(grib_file, version, reduction))}")
+    return payload_of(grib_file, version, reduction)
+
+
+def encode_parts(grib_file, model=None, version=1, max_parts=None, progress=None, stream=False):
+    """
+    Encode the given GRIB file into fragments suitable to be sent via SMS,
+    yielding them one at a time. Each timestep is read and encoded only when
+    the fragments need it, so that the first one is ready early.
+    Whether each fragment could be sent is to be given back with send(): if
+    not, the fragment is given again with a different encoding (shift).
+    Iterating with next() alone (as in a for loop) assumes every fragment
+    went through.
+    model is the bigram model (see new_bigram_model) used to choose the shift
+    of each fragment beforehand, and updated with the outcome of each send.
+    version is the format of the data: 1 for plain 4 bits values, or 2 for
+    the compressed format (see compress).
+    max_parts, if given, is how many fragments the forecast should fit in,
+    dropping some points, timesteps or precision if needed (see
+    budget_payload).
+    progress, if given (see new_progress), tells where to start from and is
+    updated as each fragment goes through, so that an interrupted
+    transmission can be resumed later on (with the same version and
+    max_parts).
+    stream, if set, encodes the forecast for this transmission only rather
+    than caching it, keeping in memory only the timestep being read and the
+    symbols not sent yet (see open_payload), for grids too large to be
+    encoded at once.
+
+    Returns True if the message could be sent.
+    """
+    payload = budget_payload(grib_file, version, max_parts, stream)
+
+    # Due to Garmin's inability to send certain character combinations (such
+    # as ">f" if I recall), this shift attempts to try different encoding schemes.
+    if model is None:
+        model = new_bigram_model()
+    return (yield from payload_parts(payload, model, progress))
+
+
+def encode(grib_file, send_part, model=None, version=1, max_parts=None, stream=False):
+    """
+    Encode the given GRIB file into fragments suitable to be sent via SMS.
+    send_part is given each fragment in turn, and should return False if the
+    send fails, in which case the fragment will be retried with a different
+    encoding (shift).
+    model, version, max_parts and stream are as for encode_parts.
+
+    Returns True if the message could be sent.
+    """
+    parts = encode_parts(grib_file, model, version, max_parts, stream=stream)
+    try:
+        part = next(parts)
+        while True:
+            part = parts.send(send_part(part))
+    except StopIteration as done:
+        return done.value
 
 
 def just_print(part):
@@ -137,216 +826,71 @@ def ignore(part):
     return True
 
 
-#
-# Decoder
-#
-
-def decode_msg(x, shift):
-    new_chars = chars_of_shift(shift)
-    decoded = []
-    counter = 0
-    while counter < len(x):
-        if x[counter] == '@':
-            decoded.append("{0:07b}".format(CONST_EXTRACHARS.index(x[counter:counter+2])))
-            counter += 2
-        else:
-            decoded.append("{0:07b}".format(new_chars.index(x[counter])))
-            counter += 1
-    #print(f"decoded={decoded}")
-    decoded = ''.join(decoded)
-    return decoded
-
-
-def to_ints(lst):
-    return [ int(x) for x in lst ]
-
-
-def to_floats(lst):
-    return [ float(x) for x in lst ]
-
-
-def reindex(data, num_hour, num_lat, num_lon):
-    assert len(data) == num_hour * num_lat * num_lon, f"{len(data)=}!={num_hour}*{num_lat}*{num_lon}"
-    i = 0
-    x = []
-    for h in range(num_hour):
-        x.append([])
-        for lat in range(num_lat):
-            x[h].append([])
-            for lon in range(num_lon):
-                x[h][lat].append(data[i])
-                i += 1
-    return x
-
-
-def decode(parts, grib_file):
-    """
-    Decode the GRIB encoded in the parts and store it in the given file.
-    """
-    assert len(parts)>0
-    # First part must contain the global header:
-    part0 = parts[0].split("\n")
-    hours = part0[0].split(',')
-    gribdate, gribtime = part0[1].split(" ")
-    latmin, latmax, lonmin, lonmax = to_floats(part0[2].split(','))
-    #print(f"{latmin=}, {latmax=}, {lonmin=}, {lonmax=}")
-    latdiff, londiff = to_floats(part0[3].split(','))
-    #print(f"{latdiff=}, {londiff=}")
-    num_lon = 1 + int(round((lonmax-lonmin)/londiff))
-    num_lat = 1 + int(round((latmax-latmin)/latdiff))
-    num_hour = len(hours)
-    num_vec = num_lon * num_lat * num_hour
-    #print(f"{num_lon=}, {num_lat=}, {num_hour=} -> {num_vec=}")
-    decoded = ''
-    for part_no, part in enumerate(parts):
-        if part_no == 0:
-            shift = int(part0[4])
-            data = part0[5:]
-        else:
-            lines = part.split("\n")
-            part_no, shift = to_ints(lines[0].split(","))
-            data = lines[1:]
-        while data[-1] == "END" or data[-1] == "":
-            data = data[:-1]
-        encoded = ''.join(data)
-        dec = decode_msg(encoded, shift)
-        decoded += dec
-    # At the end, since we consumed bits by groups of 7, the last encoded character might be decoded into more bits than necessary. Therefore, truncate the result to the number of expected bits:
-    num_bit = 4 * (num_vec * 2)  # dirs and mag
-    assert len(decoded) >= num_bit
-    decoded = decoded[0:num_bit]
-    # Now build the dataframe:
-    decoded = [decoded[i:i+4] for i in range(0, len(decoded), 4)]
-    assert len(decoded[-1]) == 4
-    decoded = [int(i, 2) for i in decoded]
-    half_len = int(len(decoded)/2)
-    #print(f"decoded:{len(decoded)}")
-    #print(f"{half_len=}")
-    mag = pd.Series(decoded[:half_len])
-    dirs = pd.Series(decoded[half_len:]).reset_index(drop=True)
-    #print(f"dirs:{len(dirs)}")
-    #print(f"mag:{len(mag)}")
-    # dirs and mag should be of the same size
-    assert len(dirs) == len(mag), f"{len(dirs)=} != {len(mag)=}"
-
-    mag = mag*5/1.94384
-    v10 = np.sin(2*np.pi*dirs/16)*mag
-    u10 = np.cos(2*np.pi*dirs/16)*mag
-
-    # Create a sample DataFrame with one array of values
-    longitude = np.linspace(lonmin, lonmax, num_lon, endpoint=True)
-    latitude = np.linspace(latmin, latmax, num_lat, endpoint=True)
-    #print(f"lon:{len(longitude)}")
-    #print(f"lat:{len(latitude)}")
-    #print(f"v10:{len(v10)}, u10:{len(u10)}")
-    # Make v10 and u10 per hour and "square":
-    v10 = reindex(v10, num_hour, num_lat, num_lon)
-    u10 = reindex(u10, num_hour, num_lat, num_lon)
-    #print(f"v10={v10}")
-    # Define the projection information
-    proj_info = {
-        'grid_type': 'regular_ll',
-        'latitude_of_first_grid_point': latitude[0],
-        'longitude_of_first_grid_point': longitude[0],
-        'latitude_of_last_grid_point': latitude[-1],
-        'longitude_of_last_grid_point': longitude[-1],
-        'Nj': len(latitude),
-        'Ni': len(longitude),
-        # does not appear to do anything:
-    #    'parameterCategory': 2,  # Parameter category for wind (2)
-    #    'parameterNumber': 2,   # Parameter number for wind direction (2)
-    }
-
-    # Create an xarray dataset with the vector data.
-    # Using hours as a 3rd index does not work.
-    # Writing the different hours successively does not work either.
-    # We are going to concatenate the files to embed all the hours.
-    try:
-        os.remove(grib_file)
-    except FileNotFoundError:
-        pass
-    for h in range(len(hours)):
-        ds = xr.Dataset({
-            'u10': (['latitude', 'longitude'], u10[h]),
-            'v10': (['latitude', 'longitude'], v10[h]),
-        }, coords={
-            'longitude': longitude,
-            'latitude': latitude,
-        }, attrs=proj_info)
-
-        # Does not appear to do anything either:
-        #ds['u10'].attrs['parameterNumber'] = 2 # GRB_WIND_VX
-        #ds['v10'].attrs['parameterNumber'] = 3 # GRB_WIND_VY
-        #ds['u10']['P2'] = hours[h]
-        #ds['v10']['P2'] = hours[h]
-
-        tmp_file = grib_file + ".tmp"
-        from cfgrib.xarray_to_grib import to_grib  # type: ignore[import-untyped]
-        to_grib(ds, tmp_file)
-
-        # Now reopen it to set the proper parameterNumber/Category and times
-        import pygrib  # type: ignore[import-untyped]
-        grbs = pygrib.open(tmp_file)
-        grb1 = grbs.message(1)
-        grb1['parameterCategory'] = 2
-        grb1['parameterNumber'] = 2
-
-        grb2 = grbs.message(2)
-        grb2['parameterCategory'] = 2
-        grb2['parameterNumber'] = 3
-
-        for grb in [grb1, grb2]:
-            ## Still no luck: Can only change existing key
-            # grb['P1'] = 0
-            # grb['P2'] = hours[h]
-            # grb['unitOfTimeRange'] = 1
-
-            # At least set the time right:
-            grb['dataDate'] = int(gribdate.replace('-', ''))
-            gh, gm, _ = gribtime.split(':')
-            gh = str(int(gh) + int(hours[h]))
-            grb['dataTime'] = int(gh + gm)
-
-        grib_with_hour = grib_file + f".{hours[h]}"
-        with open(grib_with_hour, 'wb+') as f:
-            f.write(grb1.tostring())
-            f.write(grb2.tostring())
-
-        print(f"GRIB files saved into {grib_with_hour}.")
-
-
-
-
-
-def test_decode():
-    parts = [
-"""12,24,36,48
-2023-08-30 12:00:00
-25.0,43.0,-29.0,-7.0
-2.0,2.0
-0
-&nåO&nà7&nåN=nh7&nå6+*fN&nß>+%f7&j77<f9P¿jd==.èe*b!6=rd7=
-""",
-"""1,0
-*78¤!fP&jf6"o(O&%fN&nà8=nà7=.fN*jf7=*f=<fd==*7><bf8&%f6*fhN<%9="*à==*f7+.97==(N*nå8&nhN&nhO&*à7=.åO<ff7=*å5+*77+.à=<
-""",
-"""2,0
-ff7&n7=*f9O5f#7=*h=!fhO&*d==*å7¿"*e=nà8=o*8=jå?=nhO=%B8=%f7<ff7<få7<f9>=.ß="*f6=b5>=nà7<f78&nd=*%9O&fM¿nåyXü7=¤oF@@Δ
-""",
-"""3,0
-X7O¤wΛhæfß¡WÉYFæwFΣXßÄM1wK0ΘNÑwGåS,gDΓΞnüjf6)Σ&b*jd!)@@;&nßQnΣ@%=&nåyØ$ß=&oK-(WßMFÑ"någBwXù&.@!vùΞdW¡UWåODÆΘ$@@Çåj!"
-""",
-"""4,0
-*b4É'K¿"*f4Ξn7QGÑSs¿oFwYΣÑ?¤wJΞüWåQVÉΓbåfñOWÑMléÉñ&nñÉ"ùùO¤ALa@?@%ΨT"Åå@#"@%é7wnåΣ5tnß=+ùSØ*f7=Hü#?¿nìΞc?ßO0xO!ΣXåyH
-""",
-"""5,0
-åSHègΛUnèÉñöüWÆvD@?Uo@?@?7Rgü&nüc.òùΣWÑ!
-END
-""" ]
-    decode(parts, "/tmp/test_decode.grib")
-
 def test_encode():
     encode('gfs20230830190103925.grb', just_print)
 
-#test_decode()
+
+def test_thin_grid(budgets=((1, 3), (CONST_FORMAT_VERSION, 2))):
+    """
+    Check that a forecast of a thin corridor, where most space steps would
+    leave a single latitude, still fits into the given number of parts per
+    format version (which takes every other point), streamed or not.
+    """
+    import os
+    import tempfile
+    rng = np.random.default_rng(0)
+    lats = np.arange(30, 32.5, 1)
+    lons = np.arange(-70, -30.5, 1)
+    u10, v10 = rng.normal(0, 8, (2, 12, len(lats), len(lons)))
+    with tempfile.TemporaryDirectory() as tmpdir:
+        grib_file = os.path.join(tmpdir, 'thin.grb')
+        with open(grib_file, 'wb') as f:
+            f.write(b''.join(grib_messages(u10, v10, list(range(0, 36, 3)), '2023-08-30', '12:00:00', lats, lons)))
+        for version, max_parts in budgets:
+            for stream in (False, True):
+                payload = budget_payload(grib_file, version, max_parts, stream)
+                print(f"Reduction of {version=}, {stream=}: {payload['reduction']}")
+                assert len(lats[::payload['reduction'][0]]) >= 2, payload['reduction']
+                parts = []
+                def send_part(part):
+                    parts.append(part)
+                    return True
+                assert encode(grib_file, send_part, version=version, max_parts=max_parts, stream=stream)
+                assert len(parts) <= max_parts, f"{version=}, {stream=}: {len(parts)} parts"
+
+
+def test_stream_memory(num_steps=(4, 32), tolerance=1.1):
+    """
+    Check that streaming a forecast needs no more memory with more
+    timesteps (as allocated through Python, numpy included).
+    """
+    import os
+    import tempfile
+    import tracemalloc
+    rng = np.random.default_rng(0)
+    lats = np.arange(0, 20.5, 1)
+    lons = np.arange(-60, -29.5, 1)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        grib_files = []
+        for n in num_steps:
+            grib_files.append(os.path.join(tmpdir, f"{n}.grb"))
+            u10, v10 = rng.normal(0, 8, (2, n, len(lats), len(lons)))
+            with open(grib_files[-1], 'wb') as f:
+                f.write(b''.join(grib_messages(u10, v10, list(range(0, 3*n, 3)), '2023-08-30', '12:00:00', lats, lons)))
+        for version in (1, CONST_FORMAT_VERSION):
+            # The model learns each pair of characters once whatever the
+            # forecast, so learn them beforehand:
+            model = new_bigram_model()
+            encode(grib_files[-1], ignore, model, version, stream=True)
+            peaks = []
+            for grib_file in grib_files:
+                tracemalloc.start()
+                try:
+                    encode(grib_file, ignore, model, version, stream=True)
+                    peaks.append(tracemalloc.get_traced_memory()[1])
+                finally:
+                    tracemalloc.stop()
+            print(f"Peak memory of {version=} per number of timesteps: {dict(zip(num_steps, peaks))}")
+            assert peaks[-1] < peaks[0] * tolerance, f"{version=}: {peaks=}"
+
 #encode('gfs20230830190103925.grb', just_print)
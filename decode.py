@@ -1,42 +1,243 @@
-# requirements:
+# requirements (numpy only, the GRIB files being written by decoder.py):
 # $ python -m venv $PWD/venv
 # $ source venv/bin/activate
-# $ pip install pygrib cfgrib numpy pandas xarray
-# $ apt-get install libeccodes-tools
-# Maybe:
-# $ patch venv/lib/python3.9/site-packages/gribapi/bindings.py eccodes.patch
+# $ pip install numpy
 import argparse
+import os
+import re
+import sys
 
-from codec import decode
+from decoder import decode
 
 
-def read_parts(filenames):
+# Prefixes added to the messages when they are forwarded (possibly several
+# times):
+FORWARD_RE = re.compile(r"^((fw|fwd|tr)\s*:\s*)+", re.IGNORECASE)
+# The first line of any part but the first one: part number and shift:
+PART_HEADER_RE = re.compile(r"^(\d+),(\d+)$")
+# The first two lines of the first part: forecast hours and model run time:
+HOURS_RE = re.compile(r"^\d+(,\d+)*$")
+RUN_TIME_RE = re.compile(r"^\d{4}-\d{2}-\d{2} \d{2}:\d{2}:\d{2}$")
+
+
+def clean_lines(lines):
+    """
+    Strip the given lines from spaces, and skip the empty ones.
+    Forwarding prefixes are only stripped from the first line of a part
+    (the data can start with the very same characters).
+    """
+    for line in lines:
+        line = line.strip()
+        unforwarded = FORWARD_RE.sub('', line).strip()
+        if unforwarded != line and (PART_HEADER_RE.match(unforwarded) or HOURS_RE.match(unforwarded)):
+            line = unforwarded
+        if len(line) > 0:
+            yield line
+
+
+def read_lines(filenames):
     """
-    Reconstruct the messages from the given filenames.
-    Actually concatenate it all, assuming the first one is indeed the first,
-    and then split it at messages boundary and then reorder them properly.
-    So other parts of the message can be added in any order.
+    Yield the lines of the given files in turn, the files of directories
+    being read in name order.
     """
-    assert len(filenames) > 0
-    text = ''
     for filename in filenames:
-        with open(filename, 'r') as f:
-            text += f.read()
-    #print(f"full message:\n{text}")
-    text = [
-        line.strip()
-        for line in text.split('\n')
-        if len(line) > 0 and line != 'END' ]
-    assert len(text) >= 6
-    part0 = "\n".join(text[:6])
-    parts = [ "\n".join(text[i:i+2]) for i in range(6, len(text), 2) ]
-    def part_number(part):
-        part_no, _shift = part.split("\n")[0].split(',')
-        return int(part_no)
-    parts = [ part0 ] + sorted(parts, key=part_number)
+        if os.path.isdir(filename):
+            yield from read_lines(sorted(
+                os.path.join(filename, name) for name in os.listdir(filename)))
+        else:
+            with open(filename, 'r') as f:
+                yield from f
+
+
+def new_transmission(header):
+    return {
+        # The first 4 lines of part 0, identifying the transmission:
+        'header': header,
+        # Per part number, the received versions of that part per shift, the
+        # last received one last:
+        'parts': {},
+        # The number of the part that ended with "END", if received:
+        'last': None,
+    }
+
+
+def add_part(transmission, part_no, shift, data, end):
+    """
+    Add that part to the transmission, unless it has another one with the
+    same number and shift but different data (that must then belong to
+    another transmission), in which case False is returned.
+    """
+    versions = transmission['parts'].setdefault(part_no, {})
+    if versions.get(shift, data) != data:
+        return False
+    # Duplicates are ignored, but a retransmission with another shift moves
+    # last:
+    versions.pop(shift, None)
+    versions[shift] = data
+    if end:
+        transmission['last'] = part_no
+    return True
+
+
+def parse_transmissions(lines):
+    """
+    Reconstruct the transmissions from the given lines, yielding each one
+    as soon as the next one begins (or at the end).
+    Parts can come in any order, forwarded, several times or with different
+    shifts. Parts received before their first part, or conflicting with a
+    part of the current transmission, are attached to the next transmission.
+    """
+    lines = clean_lines(lines)
+    transmission = None
+    orphans = new_transmission(None)
+    # The part being read (part_no, shift, data lines):
+    part = None
+    # Lines are looked at two at a time, to recognize the first part:
+    line = next(lines, None)
+    next_line = next(lines, None)
+
+    def end_part(end=False):
+        nonlocal part
+        if part is not None:
+            part_no, shift, data = part
+            data = ''.join(data)
+            if transmission is None or not add_part(transmission, part_no, shift, data, end):
+                if transmission is not None:
+                    print(f"Part {part_no} with shift {shift} differs from the one received before, keeping it for the next transmission", file=sys.stderr)
+                if not add_part(orphans, part_no, shift, data, end):
+                    print(f"Ignoring another different part {part_no} with shift {shift}", file=sys.stderr)
+        part = None
+
+    while line is not None:
+        if next_line is not None and HOURS_RE.match(line) and RUN_TIME_RE.match(next_line):
+            end_part()
+            header = [ line, next_line ] + [ next(lines, '') for _ in range(3) ]
+            shift_line = header.pop()
+            if transmission is None or transmission['header'] != header:
+                if transmission is not None:
+                    yield transmission
+                transmission = new_transmission(header)
+                # Adopt the parts received so far without their first part:
+                for part_no, versions in orphans['parts'].items():
+                    for shift, data in versions.items():
+                        add_part(transmission, part_no, shift, data, orphans['last'] == part_no)
+                orphans = new_transmission(None)
+            # The shift line of the first part also gives the format version:
+            part = (0, shift_line, [])
+            line = next(lines, None)
+            next_line = next(lines, None)
+            continue
+        # A short last part could have data looking like a part header:
+        elif PART_HEADER_RE.match(line) and (part is None or len(part[2]) > 0 or next_line not in (None, 'END')):
+            end_part()
+            part_no, shift = PART_HEADER_RE.match(line).groups()
+            part = (int(part_no), shift, [])
+        elif line == 'END':
+            end_part(True)
+        elif part is not None:
+            part[2].append(line)
+        else:
+            print(f"Ignoring line out of any part: {line}", file=sys.stderr)
+        line = next_line
+        next_line = next(lines, None)
+    end_part()
+    if transmission is not None:
+        yield transmission
+    if orphans['parts']:
+        print(f"Ignoring parts {sorted(orphans['parts'])} received without their first part", file=sys.stderr)
+
+
+def missing_parts(transmission):
+    """
+    Return the numbers of the parts still missing from that transmission, or
+    None if the last part is not known yet.
+    """
+    if transmission['last'] is None:
+        return None
+    return [ part_no for part_no in range(transmission['last'] + 1) if part_no not in transmission['parts'] ]
+
+
+def transmission_parts(transmission):
+    """
+    Return the parts of that complete transmission, as expected by decode.
+    Of several versions of the same part the last received one is used.
+    """
+    parts = []
+    for part_no in range(transmission['last'] + 1):
+        versions = transmission['parts'][part_no]
+        if len(versions) > 1:
+            print(f"Part {part_no} received with shifts {list(versions)}, using the last one", file=sys.stderr)
+        shift, data = list(versions.items())[-1]
+        if part_no == 0:
+            parts.append("\n".join(transmission['header'] + [ shift, data ]) + "\n")
+        else:
+            parts.append(f"{part_no},{shift}\n{data}\n")
+    parts[-1] += "END"
     return parts
 
 
+def complete_transmissions(transmissions):
+    """
+    Yield the given transmissions that are complete, telling about the
+    others.
+    """
+    for transmission in transmissions:
+        missing = missing_parts(transmission)
+        run = transmission['header'][1]
+        if missing is None:
+            print(f"Forecast of {run}: last part not received yet, ask for it with: resend", file=sys.stderr)
+        elif missing:
+            resend = ','.join(str(part_no) for part_no in missing)
+            print(f"Forecast of {run}: missing parts {resend}, ask for them with: resend {resend}", file=sys.stderr)
+        else:
+            yield transmission
+
+
+def read_parts(filenames):
+    """
+    Reconstruct the parts of the last complete transmission found in the
+    given files.
+    """
+    transmissions = list(complete_transmissions(parse_transmissions(read_lines(filenames))))
+    assert len(transmissions) > 0, "No complete transmission found"
+    if len(transmissions) > 1:
+        print(f"Found {len(transmissions)} transmissions, decoding the last one (see --batch)", file=sys.stderr)
+    return transmission_parts(transmissions[-1])
+
+
+def grib_name(transmission_no, transmission):
+    """
+    Name the GRIB file of a transmission after its model run time.
+    """
+    run_time = transmission['header'][1].replace('-', '').replace(':', '')[:13].replace(' ', '-')
+    return f"{transmission_no:03d}-{run_time}.grib"
+
+
+def decode_batch(filenames, output_dir, jobs):
+    """
+    Decode every complete transmission found in the given files (or
+    directories) into output_dir, in parallel.
+    """
+    # Only batch mode needs processes, not worth importing for one forecast:
+    from concurrent.futures import ProcessPoolExecutor
+    os.makedirs(output_dir, exist_ok=True)
+    transmissions = complete_transmissions(parse_transmissions(read_lines(filenames)))
+    with ProcessPoolExecutor(max_workers=jobs) as executor:
+        futures = [
+            (transmission['header'][1], executor.submit(decode, transmission_parts(transmission), os.path.join(output_dir, grib_name(n, transmission))))
+            for n, transmission in enumerate(transmissions) ]
+        decoded = 0
+        for run, future in futures:
+            # One bad transmission should not keep the others from being
+            # decoded:
+            try:
+                future.result()
+                decoded += 1
+            except Exception as e:
+                print(f"Forecast of {run}: could not decode it: {e!r}", file=sys.stderr)
+    print(f"Decoded {decoded} of {len(futures)} transmissions into {output_dir}.")
+
+
 def main():
     parser = argparse.ArgumentParser(
         prog='Grib Decoder',
@@ -44,17 +245,30 @@ def main():
     parser.add_argument('-o', '--output',
         type=str,
         default='output.grib',
-        help='Name of the created grib files (numeric suffix will be added)')
+        help='Name of the created grib file (all forecast hours in one file)')
+    parser.add_argument('-b', '--batch',
+        type=str,
+        metavar='OUTPUT_DIR',
+        help='Decode all the transmissions found in the inputs into that directory')
+    parser.add_argument('-j', '--jobs',
+        type=int,
+        default=None,
+        help='How many transmissions to decode at the same time in batch mode (default: one per CPU)')
     parser.add_argument('filename',
         type=str,
         default=['/dev/stdin'],
-        help='Input message(s)',
+        help='Input message(s), or directories of messages',
         nargs='*')
 
     args = parser.parse_args()
-    print(f"output={args.output}, inputs={args.filename}")
 
-    parts = read_parts(args.filename)
-    decode(parts, args.output)
+    if args.batch:
+        print(f"output directory={args.batch}, inputs={args.filename}")
+        decode_batch(args.filename, args.batch, args.jobs)
+    else:
+        print(f"output={args.output}, inputs={args.filename}")
+        parts = read_parts(args.filename)
+        decode(parts, args.output)
 
-main()
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,469 @@
+# The decoding half of the codec, which only needs numpy, so that it starts
+# quickly on the small computers used on board. The encoder (codec.py) builds
+# on the same definitions.
+import numpy as np
+import struct
+
+CONST_MAX_SHIFT = 10
+CONST_MAX_MSG_SIZE = 120
+# Magnitudes are sent in steps of that many knots, unless the shift line of
+# the first part gives another step (see codec.reductions):
+CONST_MAG_STEP = 5
+
+# Characters that can (almost) safely be sent via inReach:
+# FIXME: apparently, "Θ" can cause problems. It is not used any more from
+# version 2 of the format onward (see CONST_CODES_V2).
+CONST_CHARS = """!"#$%\'()*+,-./:;<=>?_¡£¥¿&¤0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyzÄÅÆÇÉÑØøÜßÖàäåæèéìñòöùüΔΦΓΛΩΠΨΣΘΞ"""
+# To get a full range of 128 code possibilities, these are extra two character
+# codes:
+CONST_EXTRACHARS = [ '@!', '@@', '@#', '@$', '@%', '@?' ]
+
+assert len(CONST_CHARS) + len(CONST_EXTRACHARS) == 128
+
+def chars_of_shift(shift):
+    return CONST_CHARS[shift:] + CONST_CHARS[:shift]
+
+# From version 2 onward, "Θ" is replaced by another two character code, and
+# the shift rotates all the 128 codes, two character ones included, so that
+# it also chooses which symbols take two characters:
+CONST_CHARS_V2 = CONST_CHARS.replace('Θ', '')
+CONST_CODES_V2 = list(CONST_CHARS_V2) + CONST_EXTRACHARS + [ '@&' ]
+
+assert len(CONST_CODES_V2) == 128
+
+def codes_of_shift(shift, version=1):
+    """
+    Return the code (one or two characters) of each 7 bits symbol.
+    """
+    if version == 1:
+        return list(chars_of_shift(shift)) + CONST_EXTRACHARS
+    return CONST_CODES_V2[shift:] + CONST_CODES_V2[:shift]
+
+
+def shifts_of_version(version):
+    return range(CONST_MAX_SHIFT + 1) if version == 1 else range(len(CONST_CODES_V2))
+
+#
+# Compressed format (version 2)
+#
+# Version 1 spends 4 bits of magnitude then 4 bits of direction on each grid
+# point. Version 2 rather codes each timestep in turn, magnitudes then
+# directions. Each value is predicted from the same point at the previous
+# timestep plus the change observed at its already coded neighbours (left,
+# up and up-left, combined with the median edge detector of LOCO-I), and the
+# residuals are coded with an adaptive arithmetic coder. Directions are not
+# sent where the magnitude is 0, and are then assumed unchanged.
+#
+
+CONST_FORMAT_VERSION = 2
+CONST_MAG_RESIDUALS = 31  # -15..15
+CONST_DIR_RESIDUALS = 16  # modulo 16
+# Contexts are chosen according to the timestep (first or not) and how much
+# the neighbours disagree (0, 1, 2 or more):
+CONST_NUM_CONTEXTS = 6
+CONST_CODER_FULL = (1 << 32) - 1
+CONST_CODER_HALF = 1 << 31
+CONST_CODER_QUARTER = 1 << 30
+CONST_FREQ_INCREMENT = 32
+CONST_MAX_FREQ_TOTAL = 1 << 16
+
+
+def new_freqs():
+    return ([ [1] * CONST_MAG_RESIDUALS for _ in range(CONST_NUM_CONTEXTS) ] +
+            [ [1] * CONST_DIR_RESIDUALS for _ in range(CONST_NUM_CONTEXTS) ])
+
+
+def update_freqs(freqs, totals, ctx, sym):
+    freqs[ctx][sym] += CONST_FREQ_INCREMENT
+    totals[ctx] += CONST_FREQ_INCREMENT
+    if totals[ctx] > CONST_MAX_FREQ_TOTAL:
+        freqs[ctx] = [ (f + 1) // 2 for f in freqs[ctx] ]
+        totals[ctx] = sum(freqs[ctx])
+
+
+def arith_decoder(bits):
+    """
+    Return a function decoding the next symbol of the given context from the
+    given bits (which are then assumed to be followed by 0s).
+    """
+    freqs = new_freqs()
+    totals = [ sum(f) for f in freqs ]
+    low, high, value, pos = 0, CONST_CODER_FULL, 0, 0
+
+    def next_bit():
+        nonlocal pos
+        pos += 1
+        return int(bits[pos - 1]) if pos <= len(bits) else 0
+
+    for _ in range(32):
+        value = (value << 1) | next_bit()
+
+    def decode_symbol(ctx):
+        nonlocal low, high, value
+        f = freqs[ctx]
+        rng = high - low + 1
+        count = ((value - low + 1) * totals[ctx] - 1) // rng
+        sym = 0
+        cum = 0
+        while cum + f[sym] <= count:
+            cum += f[sym]
+            sym += 1
+        high = low + rng * (cum + f[sym]) // totals[ctx] - 1
+        low = low + rng * cum // totals[ctx]
+        while True:
+            if high < CONST_CODER_HALF:
+                pass
+            elif low >= CONST_CODER_HALF:
+                low -= CONST_CODER_HALF
+                high -= CONST_CODER_HALF
+                value -= CONST_CODER_HALF
+            elif low >= CONST_CODER_QUARTER and high < 3 * CONST_CODER_QUARTER:
+                low -= CONST_CODER_QUARTER
+                high -= CONST_CODER_QUARTER
+                value -= CONST_CODER_QUARTER
+            else:
+                break
+            low <<= 1
+            high = (high << 1) | 1
+            value = (value << 1) | next_bit()
+        update_freqs(freqs, totals, ctx, sym)
+        return sym
+
+    return decode_symbol
+
+
+def decompress(bits, num_hour, num_lat, num_lon):
+    """
+    Rebuild the flat arrays of quantized magnitudes and directions from the
+    bits produced by compress.
+    """
+    decode_symbol = arith_decoder(bits)
+    mag = np.zeros((num_hour, num_lat, num_lon), dtype=np.uint8)
+    dirs = np.zeros((num_hour, num_lat, num_lon), dtype=np.uint8)
+    prev_mag = [ [0] * num_lon for _ in range(num_lat) ]
+    prev_dir = [ [0] * num_lon for _ in range(num_lat) ]
+    for t in range(num_hour):
+        cur_mag = [ [0] * num_lon for _ in range(num_lat) ]
+        cur_dir = [ [0] * num_lon for _ in range(num_lat) ]
+        for kind in ('mag', 'dir'):
+            # The changes since previous timestep, with a margin of 0s on
+            # the top and left:
+            deltas = [ [0] * (num_lon + 1) for _ in range(num_lat + 1) ]
+            for i in range(num_lat):
+                for j in range(num_lon):
+                    left = deltas[i + 1][j]
+                    up = deltas[i][j + 1]
+                    upleft = deltas[i][j]
+                    # Same as med_predict and context_of, on plain ints:
+                    lo, hi = min(left, up), max(left, up)
+                    pred = lo if upleft >= hi else hi if upleft <= lo else left + up - upleft
+                    ctx = (3 if t > 0 else 0) + min(abs(left - up), 2)
+                    if kind == 'mag':
+                        expected = min(max(prev_mag[i][j] + pred, 0), 15)
+                        cur_mag[i][j] = expected + decode_symbol(ctx) - 15
+                        deltas[i + 1][j + 1] = cur_mag[i][j] - prev_mag[i][j]
+                    else:
+                        if cur_mag[i][j] > 0:
+                            expected = (prev_dir[i][j] + pred) % 16
+                            cur_dir[i][j] = (expected + decode_symbol(CONST_NUM_CONTEXTS + ctx)) % 16
+                        else:
+                            cur_dir[i][j] = prev_dir[i][j]
+                        deltas[i + 1][j + 1] = (cur_dir[i][j] - prev_dir[i][j] + 8) % 16 - 8
+        mag[t] = cur_mag
+        dirs[t] = cur_dir
+        prev_mag = cur_mag
+        prev_dir = cur_dir
+    return mag.ravel(), dirs.ravel()
+
+
+#
+# Decoder
+#
+
+def reverse_table(shift, version=1):
+    """
+    Map each character of the given shift back into its symbol number.
+    The two characters codes are looked up by their second character.
+    """
+    codes = codes_of_shift(shift, version)
+    table = { c: i for i, c in enumerate(codes) if len(c) == 1 }
+    extra = { c[1]: i for i, c in enumerate(codes) if len(c) == 2 }
+    return table, extra
+
+# Reverse tables are only built for the shifts actually received, not to
+# slow down start up:
+reverse_tables = {}
+
+
+def decode_msg(x, shift, version=1):
+    """
+    Turn the received characters back into an array of 7 bits symbols.
+    """
+    if (shift, version) not in reverse_tables:
+        reverse_tables[(shift, version)] = reverse_table(shift, version)
+    table, extra = reverse_tables[(shift, version)]
+    decoded = []
+    counter = 0
+    while counter < len(x):
+        if x[counter] == '@':
+            decoded.append(extra[x[counter+1]])
+            counter += 2
+        else:
+            decoded.append(table[x[counter]])
+            counter += 1
+    return np.array(decoded, dtype=np.uint8)
+
+
+# Weights to turn 4 bits (MSB first) into a nibble:
+CONST_NIBBLE_WEIGHTS = 1 << np.arange(3, -1, -1)
+
+def unpack_bits(symbols):
+    """
+    Unpack an array of 7 bits symbols into the array of their bits.
+    """
+    return np.unpackbits(np.asarray(symbols, dtype=np.uint8)[:, None], axis=1)[:, 1:].ravel()
+
+
+def unpack_symbols(symbols, num_nibbles):
+    """
+    Unpack an array of 7 bits symbols into the first num_nibbles 4 bits
+    values they encode.
+    """
+    bits = unpack_bits(symbols)
+    assert len(bits) >= 4 * num_nibbles, f"{len(bits)=} < 4 * {num_nibbles}"
+    return (bits[:4 * num_nibbles].reshape(-1, 4) @ CONST_NIBBLE_WEIGHTS).astype(np.uint8)
+
+
+def to_ints(lst):
+    return [ int(x) for x in lst ]
+
+
+def to_floats(lst):
+    return [ float(x) for x in lst ]
+
+
+# GRIB2 sections that are the same for all the messages written here:
+# Section 6: no bitmap.
+CONST_GRIB_BITMAP = struct.pack('>IBB', 6, 6, 255)
+CONST_GRIB_END = b'7777'
+CONST_GRIB_BITS_PER_VALUE = 16
+
+def grib_int(value, size=4):
+    """
+    Pack a signed integer the GRIB way: sign bit then magnitude.
+    """
+    sign = 1 << (8 * size - 1) if value < 0 else 0
+    return (sign | abs(int(value))).to_bytes(size, 'big')
+
+
+def grib_micro_degrees(degrees, longitude=False):
+    if longitude:
+        degrees = degrees % 360
+    return grib_int(round(degrees * 1e6))
+
+
+def grib_grid(latitude, longitude):
+    """
+    Section 3: regular latitude/longitude grid (template 3.0) on a spherical
+    earth, scanned west to east then south to north.
+    """
+    num_lat, num_lon = len(latitude), len(longitude)
+    latdiff = abs(latitude[-1] - latitude[0]) / max(num_lat - 1, 1)
+    londiff = abs(longitude[-1] - longitude[0]) / max(num_lon - 1, 1)
+    body = (struct.pack('>BIBBH', 0, num_lat * num_lon, 0, 0, 0) +
+        # Shape of the earth (radius 6371229m) and its missing parameters:
+        struct.pack('>B', 6) + b'\xff' * 15 +
+        struct.pack('>II', num_lon, num_lat) +
+        # Basic angle and subdivisions:
+        struct.pack('>I', 0) + b'\xff' * 4 +
+        grib_micro_degrees(latitude[0]) + grib_micro_degrees(longitude[0], True) +
+        # Increments given:
+        struct.pack('>B', 48) +
+        grib_micro_degrees(latitude[-1]) + grib_micro_degrees(longitude[-1], True) +
+        grib_micro_degrees(londiff) + grib_micro_degrees(latdiff) +
+        # Scanning mode: j scans positively:
+        struct.pack('>B', 64))
+    return struct.pack('>IB', 5 + len(body), 3) + body
+
+
+def grib_product(param_no, hour):
+    """
+    Section 4: analysis or forecast at a point in time (template 4.0) of a
+    wind component 10m above ground.
+    """
+    body = (struct.pack('>HH', 0, 0) +
+        # Momentum category, U or V component:
+        struct.pack('>BB', 2, param_no) +
+        # Analysis, background and generating process as in ecCodes'
+        # samples, no cut-off:
+        struct.pack('>BBBHB', 0, 255, 128, 0, 0) +
+        # Forecast time in hours:
+        struct.pack('>BI', 1, int(hour)) +
+        # Height above ground of 10m, no second surface:
+        struct.pack('>BBI', 103, 0, 10) + b'\xff' * 6)
+    return struct.pack('>IB', 5 + len(body), 4) + body
+
+
+def binary_scale(value_range, bits):
+    """
+    Return the smallest binary scale factor E such that value_range / 2**E
+    fits in the given number of bits (as ecCodes does).
+    """
+    max_int = (1 << bits) - 1
+    scale = 0
+    while value_range * 2.0**-scale <= max_int:
+        scale -= 1
+    while int(value_range * 2.0**-scale + 0.5) > max_int:
+        scale += 1
+    return scale
+
+
+def grib_packed(values):
+    """
+    Sections 5 and 7: the values packed as 16 bits integers (template 5.0),
+    with a float32 reference value no more than the minimum and a binary
+    scale factor. A constant field takes no bits at all.
+    """
+    values = np.ravel(values).astype(np.float64)
+    vmin, vmax = values.min(), values.max()
+    # Nearest float32 not above the minimum:
+    reference = np.float32(vmin)
+    if reference > vmin:
+        reference = np.nextafter(reference, np.float32(-np.inf))
+    if vmin == vmax:
+        bits, scale, data = 0, 0, b''
+    else:
+        bits = CONST_GRIB_BITS_PER_VALUE
+        scale = binary_scale(vmax - float(reference), bits)
+        data = ((values - float(reference)) * 2.0**-scale + 0.5).astype('>u2').tobytes()
+    body = (struct.pack('>IH', len(values), 0) + struct.pack('>f', reference) +
+        grib_int(scale, 2) +
+        # Decimal scale factor, bits per value, floating point values:
+        struct.pack('>HBB', 0, bits, 0))
+    return (struct.pack('>IB', 5 + len(body), 5) + body +
+            CONST_GRIB_BITMAP +
+            struct.pack('>IB', 5 + len(data), 7) + data)
+
+
+def grib_messages(u10, v10, hours, gribdate, gribtime, latitude, longitude):
+    """
+    Build in memory the GRIB2 messages for the given (hour, lat, lon) wind
+    components, two per forecast hour (U then V), all sharing the same
+    reference time.
+    Only numpy is needed, the messages being the same as what ecCodes'
+    regular_ll_sfc_grib2 sample gives once filled.
+    """
+    year, month, day = to_ints(gribdate.split('-'))
+    gh, gm, _ = to_ints(gribtime.split(':'))
+    # Section 1: ECMWF, start of forecast, operational forecast products:
+    identification = struct.pack('>IBHHBBBHBBBBBBB', 21, 1, 98, 0, 4, 0, 1, year, month, day, gh, gm, 0, 0, 2)
+    grid = grib_grid(latitude, longitude)
+    messages = []
+    for h, hour in enumerate(hours):
+        for param_no, values in [ (2, u10[h]), (3, v10[h]) ]:
+            sections = identification + grid + grib_product(param_no, hour) + grib_packed(values) + CONST_GRIB_END
+            # Section 0: meteorological products, GRIB edition 2:
+            messages.append(b'GRIB' + struct.pack('>HBBQ', 0xffff, 0, 2, 16 + len(sections)) + sections)
+    return messages
+
+
+def decode(parts, grib_file):
+    """
+    Decode the GRIB encoded in the parts and store it in the given file.
+    """
+    assert len(parts)>0
+    # First part must contain the global header:
+    part0 = parts[0].split("\n")
+    hours = part0[0].split(',')
+    gribdate, gribtime = part0[1].split(" ")
+    latmin, latmax, lonmin, lonmax = to_floats(part0[2].split(','))
+    #print(f"{latmin=}, {latmax=}, {lonmin=}, {lonmax=}")
+    latdiff, londiff = to_floats(part0[3].split(','))
+    #print(f"{latdiff=}, {londiff=}")
+    num_lon = 1 + int(round((lonmax-lonmin)/londiff))
+    num_lat = 1 + int(round((latmax-latmin)/latdiff))
+    num_hour = len(hours)
+    num_vec = num_lon * num_lat * num_hour
+    #print(f"{num_lon=}, {num_lat=}, {num_hour=} -> {num_vec=}")
+    # The format version follows the shift, if not 1, then the step of the
+    # magnitudes if not the usual one:
+    shift_line = to_ints(part0[4].split(','))
+    version = shift_line[1] if len(shift_line) > 1 else 1
+    mag_step = shift_line[2] if len(shift_line) > 2 else CONST_MAG_STEP
+    decoded = []
+    for part_no, part in enumerate(parts):
+        if part_no == 0:
+            shift = shift_line[0]
+            data = part0[5:]
+        else:
+            lines = part.split("\n")
+            part_no, shift = to_ints(lines[0].split(","))
+            data = lines[1:]
+        while data and (data[-1] == "END" or data[-1] == ""):
+            data = data[:-1]
+        encoded = ''.join(data)
+        decoded.append(decode_msg(encoded, shift, version))
+    if version == 1:
+        # At the end, since we consumed bits by groups of 7, the last encoded
+        # character might be decoded into more bits than necessary. Therefore,
+        # unpack only the expected number of values:
+        decoded = unpack_symbols(np.concatenate(decoded), num_vec * 2)  # dirs and mag
+        mag = decoded[:num_vec]
+        dirs = decoded[num_vec:]
+    else:
+        assert version == CONST_FORMAT_VERSION, f"Unknown format {version=}"
+        mag, dirs = decompress(unpack_bits(np.concatenate(decoded)), num_hour, num_lat, num_lon)
+    # dirs and mag should be of the same size
+    assert len(dirs) == len(mag), f"{len(dirs)=} != {len(mag)=}"
+
+    mag = mag*mag_step/1.94384
+    v10 = np.sin(2*np.pi*dirs/16)*mag
+    u10 = np.cos(2*np.pi*dirs/16)*mag
+
+    longitude = np.linspace(lonmin, lonmax, num_lon, endpoint=True)
+    latitude = np.linspace(latmin, latmax, num_lat, endpoint=True)
+    # Make v10 and u10 per hour and "square":
+    v10 = v10.reshape(num_hour, num_lat, num_lon)
+    u10 = u10.reshape(num_hour, num_lat, num_lon)
+
+    # Build all the messages in memory and write them at once, so that a
+    # single file embeds all the hours:
+    messages = grib_messages(u10, v10, hours, gribdate, gribtime, latitude, longitude)
+    with open(grib_file, 'wb') as f:
+        f.write(b''.join(messages))
+
+    print(f"GRIB file saved into {grib_file}.")
+
+
+
+
+
+
+def test_decode():
+    parts = [
+"""12,24,36,48
+2023-08-30 12:00:00
+25.0,43.0,-29.0,-7.0
+2.0,2.0
+0
+&nåO&nà7&nåN=nh7&nå6+*fN&nß>+%f7&j77<f9P¿jd==.èe*b!6=rd7=
+""",
+"""1,0
+*78¤!fP&jf6"o(O&%fN&nà8=nà7=.fN*jf7=*f=<fd==*7><bf8&%f6*fhN<%9="*à==*f7+.97==(N*nå8&nhN&nhO&*à7=.åO<ff7=*å5+*77+.à=<
+""",
+"""2,0
+ff7&n7=*f9O5f#7=*h=!fhO&*d==*å7¿"*e=nà8=o*8=jå?=nhO=%B8=%f7<ff7<få7<f9>=.ß="*f6=b5>=nà7<f78&nd=*%9O&fM¿nåyXü7=¤oF@@Δ
+""",
+"""3,0
+X7O¤wΛhæfß¡WÉYFæwFΣXßÄM1wK0ΘNÑwGåS,gDΓΞnüjf6)Σ&b*jd!)@@;&nßQnΣ@%=&nåyØ$ß=&oK-(WßMFÑ"någBwXù&.@!vùΞdW¡UWåODÆΘ$@@Çåj!"
+""",
+"""4,0
+*b4É'K¿"*f4Ξn7QGÑSs¿oFwYΣÑ?¤wJΞüWåQVÉΓbåfñOWÑMléÉñ&nñÉ"ùùO¤ALa@?@%ΨT"Åå@#"@%é7wnåΣ5tnß=+ùSØ*f7=Hü#?¿nìΞc?ßO0xO!ΣXåyH
+""",
+"""5,0
+åSHègΛUnèÉñöüWÆvD@?Uo@?@?7Rgü&nüc.òùΣWÑ!
+END
+""" ]
+    decode(parts, "/tmp/test_decode.grib")
+
+#test_decode()
@@ -0,0 +1,434 @@
+# End to end load test of mail2grib, against local stand-ins for the IMAP and
+# SMTP servers, for Saildocs and for Garmin's TxtMsg endpoint.
+# $ python loadtest.py --boats 50 --requests 5 --reject 'f>' --reject '&n'
+# Each boat sends its forecast request into the (fake) mailbox, mail2grib
+# asks (fake) Saildocs by email, which answers a synthetic GRIB file after a
+# while, and mail2grib then posts the parts to the (fake) Garmin endpoint.
+# What's measured is the time from each request to its last part.
+import argparse
+import email
+import email.policy
+from email.message import EmailMessage
+from email.utils import formatdate
+import http.server
+import json
+import os
+import random
+import socketserver
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+import numpy as np
+
+import bench
+from codec import bigrams
+
+
+CONST_SERVICE_EMAIL = 'grib@localhost'
+
+
+#
+# Mailbox
+#
+
+def new_mailbox():
+    # Each message is [uid, raw, seen]:
+    return { 'messages': [], 'cond': threading.Condition() }
+
+
+def deliver(mailbox, msg):
+    with mailbox['cond']:
+        uid = len(mailbox['messages']) + 1
+        mailbox['messages'].append([uid, msg.as_bytes(policy=email.policy.SMTP), False])
+        mailbox['cond'].notify_all()
+
+
+def imap_server(mailbox, port=0):
+    """
+    Serve the mailbox over IMAP, with just enough of the protocol for
+    imap_tools (including IDLE).
+    """
+    class Handler(socketserver.StreamRequestHandler):
+        def send(self, line):
+            self.wfile.write(line if isinstance(line, bytes) else line.encode() + b'\r\n')
+            self.wfile.flush()
+
+        def handle(self):
+            self.send('* OK IMAP4rev1 ready')
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    return
+                tag, cmd, *rest = line.decode().rstrip('\r\n').split(' ', 2)
+                cmd = cmd.upper()
+                args = rest[0] if rest else ''
+                if cmd == 'CAPABILITY':
+                    self.send('* CAPABILITY IMAP4rev1 IDLE')
+                elif cmd == 'SELECT':
+                    self.known = len(mailbox['messages'])
+                    self.send(f"* {self.known} EXISTS")
+                    self.send('* OK [UIDVALIDITY 1] ok')
+                    self.send(f'{tag} OK [READ-WRITE] SELECT completed')
+                    continue
+                elif cmd == 'LOGOUT':
+                    self.send('* BYE')
+                    self.send(f'{tag} OK LOGOUT completed')
+                    return
+                elif cmd == 'UID':
+                    sub, sargs = args.split(' ', 1)
+                    if sub.upper() == 'SEARCH':
+                        with mailbox['cond']:
+                            self.known = len(mailbox['messages'])
+                            uids = [ str(uid) for uid, _raw, seen in mailbox['messages']
+                                     if 'UNSEEN' not in sargs.upper() or not seen ]
+                        self.send('* SEARCH ' + ' '.join(uids))
+                    elif sub.upper() == 'FETCH':
+                        uid = int(sargs.split(' ', 1)[0])
+                        with mailbox['cond']:
+                            msg = mailbox['messages'][uid - 1]
+                            if 'PEEK' not in sargs.upper():
+                                msg[2] = True
+                        raw = msg[1]
+                        self.send(f'* {uid} FETCH (UID {uid} FLAGS (\\Seen) RFC822.SIZE {len(raw)} BODY[] {{{len(raw)}}}\r\n'.encode() + raw + b')\r\n')
+                elif cmd == 'IDLE':
+                    self.idle(tag)
+                # Anything else (LOGIN, NOOP...) just succeeds:
+                self.send(f'{tag} OK {cmd} completed')
+
+        def idle(self, tag):
+            # Notify the messages arrived since the last search, as soon as
+            # there are some:
+            self.send('+ idling')
+            done = threading.Event()
+            def notify():
+                # imap_tools would not see a notification that came along
+                # with the continuation line, so leave it time to read it:
+                done.wait(0.05)
+                with mailbox['cond']:
+                    while not done.is_set() and len(mailbox['messages']) == self.known:
+                        mailbox['cond'].wait(0.1)
+                    count = len(mailbox['messages'])
+                if not done.is_set():
+                    self.send(f'* {count} EXISTS')
+            notifier = threading.Thread(target=notify, daemon=True)
+            notifier.start()
+            self.rfile.readline()  # DONE
+            done.set()
+            notifier.join()
+
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    return server
+
+
+def smtp_server(on_mail, port=0):
+    """
+    Accept any mail (without TLS, with any credentials) and give the parsed
+    messages to on_mail.
+    """
+    class Handler(socketserver.StreamRequestHandler):
+        def send(self, line):
+            self.wfile.write(line.encode() + b'\r\n')
+            self.wfile.flush()
+
+        def handle(self):
+            self.send('220 localhost ESMTP ready')
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    return
+                cmd = line.decode().strip().split(' ', 1)[0].upper()
+                if cmd == 'EHLO':
+                    self.send('250-localhost')
+                    self.send('250 AUTH PLAIN')
+                elif cmd == 'AUTH':
+                    self.send('235 Authentication successful')
+                elif cmd == 'DATA':
+                    self.send('354 End data with <CR><LF>.<CR><LF>')
+                    data = b''
+                    while True:
+                        line = self.rfile.readline()
+                        if not line or line == b'.\r\n':
+                            break
+                        data += line[1:] if line.startswith(b'..') else line
+                    on_mail(email.message_from_bytes(data, policy=email.policy.default))
+                    self.send('250 OK')
+                elif cmd == 'QUIT':
+                    self.send('221 Bye')
+                    return
+                elif cmd in ('HELO', 'MAIL', 'RCPT', 'RSET', 'NOOP'):
+                    self.send('250 OK')
+                else:
+                    self.send('502 Command not implemented')
+
+    server = socketserver.ThreadingTCPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    return server
+
+
+#
+# Saildocs
+#
+
+def request_grid(request):
+    """
+    Return the grid (see bench.CONST_GRIDS) asked by that Saildocs request,
+    as in: "gfs:25n,41n,29w,009w|2,2|12,24,36,48|wind".
+    """
+    def degrees(coord):
+        value = float(coord[:-1])
+        return -value if coord[-1].lower() in 'sw' else value
+    area, res, hours = request.split(':', 1)[1].split('|')[:3]
+    lat1, lat2, lon1, lon2 = [ degrees(coord) for coord in area.split(',') ]
+    return (min(lat1, lat2), max(lat1, lat2), min(lon1, lon2), max(lon1, lon2),
+            float(res.split(',')[0]), [ int(hour) for hour in hours.split(',') ])
+
+
+def saildocs_responder(mailbox, turnaround, tmpdir):
+    """
+    Return the on_mail function answering Saildocs requests ("send ..."),
+    after turnaround seconds, with a synthetic GRIB file.
+    """
+    gribs = {}
+    gribs_lock = threading.Lock()
+
+    def grib_of_request(request):
+        with gribs_lock:
+            if request not in gribs:
+                grib_file = os.path.join(tmpdir, f"saildocs{len(gribs)}.grb")
+                bench.write_synthetic_grib(grib_file, request_grid(request), seed=len(gribs))
+                with open(grib_file, 'rb') as f:
+                    gribs[request] = f.read()
+            return gribs[request]
+
+    def answer(request):
+        msg = EmailMessage()
+        msg['From'] = 'query-reply@saildocs.com'
+        msg['To'] = CONST_SERVICE_EMAIL
+        msg['Subject'] = 'Saildocs Grib File'
+        msg['Date'] = formatdate()
+        msg.set_content(f"Data extracted from GFS model\r\nrequest code: {request}\r\n")
+        msg.add_attachment(grib_of_request(request), maintype='application', subtype='octet-stream',
+                           filename=f"gfs{random.getrandbits(32):08x}.grb")
+        deliver(mailbox, msg)
+
+    def on_mail(msg):
+        for line in msg.get_content().splitlines():
+            if line.startswith('send '):
+                threading.Timer(turnaround, answer, args=(line[5:].strip(),)).start()
+
+    return on_mail
+
+
+#
+# Garmin
+#
+
+def new_results():
+    return {
+        # Per boat Guid:
+        'time_requested': {},
+        'time_done': {},
+        'parts': {},
+        'rejected': {},
+        'lock': threading.Lock(),
+    }
+
+
+def garmin_server(results, rejected_pairs, port=0):
+    """
+    Accept the SMS posted to TextMessage/TxtMsg, unless they contain one of
+    the rejected pairs of characters, and record when each boat got its
+    last part.
+    """
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def do_POST(self):
+            length = int(self.headers.get('content-length', 0))
+            form = urllib.parse.parse_qs(self.rfile.read(length).decode())
+            guid = form['Guid'][0]
+            message = form['ReplyMessage'][0]
+            rejected = bigrams(message) & rejected_pairs
+            with results['lock']:
+                if rejected:
+                    results['rejected'][guid] = results['rejected'].get(guid, 0) + 1
+                else:
+                    results['parts'][guid] = results['parts'].get(guid, 0) + 1
+                    if message.endswith('END'):
+                        results['time_done'][guid] = time.time()
+            self.send_response(500 if rejected else 200)
+            self.send_header('content-length', '0')
+            self.end_headers()
+
+        def log_message(self, format, *args):
+            pass
+
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    server.daemon_threads = True
+    return server
+
+
+#
+# Load
+#
+
+def boat_request(boat_no, num_requests, max_parts=None):
+    """
+    The forecast request of that boat: boats share num_requests distinct
+    areas.
+    """
+    area = boat_no % num_requests
+    request = f"gfs:{20 + area}n,{30 + area}n,70w,60w|1,1|12,24,36,48|wind"
+    return request if max_parts is None else f"{request} max {max_parts}"
+
+
+def send_boat_request(mailbox, results, boat_no, request):
+    guid = f"{boat_no:08x}-0000-0000-0000-000000000000"
+    msg = EmailMessage()
+    msg['From'] = 'no.reply.inreach@garmin.com'
+    msg['To'] = CONST_SERVICE_EMAIL
+    msg['Subject'] = f"Message inReach from Boat {boat_no}"
+    msg['Date'] = formatdate()
+    msg.set_content(
+        f"{request}\r\n\r\n"
+        f"View the location or send a reply to Boat {boat_no}:\r\n"
+        f"https://eur.explore.garmin.com/textmessage/txtmsg?extId={guid}&adr={urllib.parse.quote(CONST_SERVICE_EMAIL)}\r\n")
+    with results['lock']:
+        results['time_requested'][guid] = time.time()
+    deliver(mailbox, msg)
+
+
+def start(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server.server_address[1]
+
+
+def print_results(results, num_boats):
+    with results['lock']:
+        latencies = [ results['time_done'][guid] - time_requested
+                      for guid, time_requested in results['time_requested'].items()
+                      if guid in results['time_done'] ]
+        num_parts = sum(results['parts'].values())
+        num_rejected = sum(results['rejected'].values())
+    print(f"{len(latencies)}/{num_boats} boats got their forecast, "
+          f"{num_parts} parts sent, {num_rejected} rejected")
+    if latencies:
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+        print(f"request to last part: min {min(latencies):.1f}s, p50 {p50:.1f}s, "
+              f"p90 {p90:.1f}s, p99 {p99:.1f}s, max {max(latencies):.1f}s")
+    return latencies
+
+
+def read_metrics(metrics_file):
+    if not os.path.exists(metrics_file):
+        return None
+    with open(metrics_file, 'r') as f:
+        return json.load(f)
+
+
+def print_metrics(metrics):
+    """
+    Print where mail2grib spent its time, according to its metrics.
+    """
+    print(f"{'stage':>22} {'count':>6} {'total s':>9} {'p50 s':>7} {'p90 s':>7} {'max s':>7}")
+    for stage, stats in sorted(metrics['stages'].items(), key=lambda item: -item[1]['total_s']):
+        print(f"{stage:>22} {stats['count']:>6} {stats['total_s']:>9.2f} {stats['p50_s']:>7.2f} {stats['p90_s']:>7.2f} {stats['max_s']:>7.2f}")
+    print(', '.join(f"{counter}: {value}" for counter, value in sorted(metrics['counters'].items())))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        prog='mail2grib load test',
+        description='Run mail2grib against local stand-ins of the mail servers, Saildocs and Garmin')
+    parser.add_argument('-b', '--boats', type=int, default=50, help="How many boats request a forecast")
+    parser.add_argument('-r', '--requests', type=int, default=5, help="How many distinct forecasts the boats ask for")
+    parser.add_argument('--rate', type=float, default=0, help="Boat requests per second (0: all at once)")
+    parser.add_argument('--turnaround', type=float, default=5, help="How long (in seconds) Saildocs takes to answer")
+    parser.add_argument('--sms-delay', type=float, default=0.5, help="SMS_DELAY given to mail2grib")
+    parser.add_argument('--query-delay', type=float, default=1, help="QUERY_DELAY given to mail2grib")
+    parser.add_argument('--reject', action='append', default=[], help="Pair of characters Garmin refuses to send (can be repeated)")
+    parser.add_argument('--max-parts', type=int, help="Maximum number of parts the boats ask their forecast in")
+    parser.add_argument('-f', '--format-version', type=int, default=1, help="Format version of the encoded data")
+    parser.add_argument('--stream-encode', action='store_true', help="Have the service encode each forecast as a stream, for each boat")
+    parser.add_argument('--timeout', type=float, default=600, help="How long (in seconds) to wait for all the boats")
+    parser.add_argument('--json', type=str, help="Also save the latencies into that file")
+    parser.add_argument('--log', type=str, help="Where to save the logs of mail2grib (default: only shown if it fails)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmpdir:
+        mailbox = new_mailbox()
+        results = new_results()
+        imap_port = start(imap_server(mailbox))
+        smtp_port = start(smtp_server(saildocs_responder(mailbox, args.turnaround, tmpdir)))
+        garmin_port = start(garmin_server(results, set(args.reject)))
+
+        mail_conf_file = os.path.join(tmpdir, 'mail-conf.json')
+        with open(mail_conf_file, 'w') as f:
+            json.dump({
+                'email': CONST_SERVICE_EMAIL,
+                'username': 'grib',
+                'password': 'grib',
+                'folder': 'INBOX',
+                'imap-host': '127.0.0.1',
+                'imap-port': imap_port,
+                'imap-ssl': False,
+                'smtp-host': '127.0.0.1',
+                'smtp-port': smtp_port,
+                'smtp-starttls': False,
+                'garmin-url': f"http://127.0.0.1:{garmin_port}",
+                'format-version': args.format_version,
+                'stream-encode': args.stream_encode,
+            }, f)
+        env = {
+            **os.environ,
+            'ATTACHMENTS_PATH': os.path.join(tmpdir, 'attachments'),
+            'SMS_DELAY': str(args.sms_delay),
+            'QUERY_DELAY': str(args.query_delay),
+        }
+        mail2grib = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'mail2grib.py')
+        log_file = args.log or os.path.join(tmpdir, 'mail2grib.log')
+        with open(log_file, 'w') as log:
+            service = subprocess.Popen(
+                [ sys.executable, mail2grib, '-m', mail_conf_file, '--idle', '--debug',
+                  '--state-file', os.path.join(tmpdir, 'state.sqlite') ],
+                cwd=tmpdir, env=env, stdout=log, stderr=subprocess.STDOUT)
+            try:
+                for boat_no in range(args.boats):
+                    send_boat_request(mailbox, results, boat_no, boat_request(boat_no, args.requests, args.max_parts))
+                    if args.rate > 0:
+                        time.sleep(1 / args.rate)
+                deadline = time.time() + args.timeout
+                while time.time() < deadline and service.poll() is None:
+                    with results['lock']:
+                        if len(results['time_done']) >= args.boats:
+                            break
+                    time.sleep(0.1)
+                # mail2grib saves its metrics once done with each mail, a bit
+                # after the last part:
+                metrics_file = os.path.join(tmpdir, '.metrics.json')
+                deadline = time.time() + 10
+                while time.time() < deadline and service.poll() is None:
+                    metrics = read_metrics(metrics_file)
+                    if metrics and sum(metrics['counters'].get(counter, 0) for counter in ('forecasts_sent', 'forecasts_failed')) >= args.boats:
+                        break
+                    time.sleep(0.1)
+            finally:
+                service.terminate()
+                service.wait()
+        if service.returncode not in (0, -15) and not args.log:
+            with open(log_file, 'r') as log:
+                print(log.read())
+        metrics = read_metrics(metrics_file)
+        if metrics:
+            print_metrics(metrics)
+    latencies = print_results(results, args.boats)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(sorted(latencies), f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
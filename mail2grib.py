@@ -1,49 +1,168 @@
 import argparse
-from codec import encode, just_print
-from datetime import datetime, timedelta
-from imap_tools import MailBox, AND
+from codec import budget_payload, cut_grib, encode, just_print, new_bigram_model, new_progress, payload_parts, read_run_time
+import collections
+import contextlib
+import hashlib
+from imap_tools import MailBox, MailBoxUnencrypted, AND
 import json
 import logging
 import os
 import pathlib
+import queue
 import random
 import re
 import requests
-from smtplib import SMTP
+import signal
+from smtplib import SMTP, SMTPException
+import sqlite3
+import sys
+import threading
 import time
 import traceback
 
 
-ATTACHMENTS_PATH = os.environ.get("ATTACHMENTS_PATH", "/tmp/GRIB-via-inReach/attachments") # Where you want to save attachment files.
+ATTACHMENTS_PATH = os.environ.get("ATTACHMENTS_PATH") # Where you want to also archive the received GRIB files (not archived if unset).
+ATTACHMENTS_MAX_SIZE = int(os.environ.get("ATTACHMENTS_MAX_SIZE", 500_000_000)) # Max total size (in bytes) of the archive, the oldest files being deleted.
+BIGRAMS_FILE = os.environ.get("BIGRAMS_FILE", ".bigrams.json") # Where the character pairs Garmin refuses to send are learned.
+CACHE_TTL = int(os.environ.get("CACHE_TTL", 3 * 3600)) # For how long (in seconds) a received forecast is served again.
+CACHE_MAX_SIZE = int(os.environ.get("CACHE_MAX_SIZE", 50_000_000)) # Max total size (in bytes) of the cached GRIB files.
+MAX_CONCURRENT_SENDS = int(os.environ.get("MAX_CONCURRENT_SENDS", 16)) # How many sailors can be sent their forecast at the same time.
+SAILDOCS_WORKERS = int(os.environ.get("SAILDOCS_WORKERS", 2)) # How many requests can be sent to Saildocs at the same time.
+QUERY_DELAY = float(os.environ.get("QUERY_DELAY", 30)) # How long (in seconds) a request waits for others to be merged with before being sent to Saildocs.
+ENCODE_WORKERS = int(os.environ.get("ENCODE_WORKERS", 1)) # How many received forecasts can be encoded at the same time.
+STATE_TTL = int(os.environ.get("STATE_TTL", 24 * 3600)) # For how long (in seconds) a forecast request waits for its answer.
+JOB_MAX_ATTEMPTS = int(os.environ.get("JOB_MAX_ATTEMPTS", 5)) # How many times a job is tried (sending to Saildocs or to a sailor...) before giving up on it.
+JOB_RETRY_DELAY = float(os.environ.get("JOB_RETRY_DELAY", 60)) # How long (in seconds) to wait before trying a failed job again, doubled after each new failure.
+SMS_DELAY = float(os.environ.get("SMS_DELAY", 10)) # How long (in seconds) to give inReach to send each SMS.
+METRICS_FILE = os.environ.get("METRICS_FILE", ".metrics.json") # Where the time spent in each stage is reported.
+
+
+# Timings of each stage and counters, along with the last forwarded forecasts,
+# saved into METRICS_FILE after each mail:
+CONST_METRICS_SAMPLES = 1000  # per stage, for the percentiles
+CONST_METRICS_REQUESTS = 100
+metrics = {
+    'since': time.time(),
+    'stages': {},
+    'samples': {},
+    'counters': collections.Counter(),
+    'requests': collections.deque(maxlen=CONST_METRICS_REQUESTS),
+}
+metrics_lock = threading.Lock()
+
+def record_time(stage, seconds):
+    with metrics_lock:
+        if stage not in metrics['stages']:
+            metrics['stages'][stage] = { 'count': 0, 'total_s': 0., 'max_s': 0. }
+            metrics['samples'][stage] = collections.deque(maxlen=CONST_METRICS_SAMPLES)
+        stats = metrics['stages'][stage]
+        stats['count'] += 1
+        stats['total_s'] += seconds
+        stats['max_s'] = max(stats['max_s'], seconds)
+        metrics['samples'][stage].append(seconds)
+
+
+@contextlib.contextmanager
+def timed(stage):
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        record_time(stage, time.monotonic() - start)
+
+
+def count(counter, n=1):
+    with metrics_lock:
+        metrics['counters'][counter] += n
+
+
+def record_request(req):
+    with metrics_lock:
+        metrics['requests'].append(req)
+
+
+def save_metrics(metrics_file):
+    """
+    Write the metrics as JSON, with the median and 90th percentile of the
+    last CONST_METRICS_SAMPLES timings of each stage.
+    """
+    def percentile(samples, p):
+        return samples[min(len(samples) - 1, int(len(samples) * p))]
+
+    with metrics_lock:
+        stages = {}
+        for stage, stats in metrics['stages'].items():
+            samples = sorted(metrics['samples'][stage])
+            stages[stage] = {
+                **stats,
+                'p50_s': percentile(samples, 0.5),
+                'p90_s': percentile(samples, 0.9),
+            }
+        report = {
+            'since': metrics['since'],
+            'updated': time.time(),
+            'stages': stages,
+            'counters': dict(metrics['counters']),
+            'requests': list(metrics['requests']),
+        }
+        # Replace the file at once, so that readers never see half of it
+        # (the lock also keeps workers from writing it at the same time):
+        with open(metrics_file + '.tmp', 'w') as f:
+            json.dump(report, f, indent=2)
+        os.replace(metrics_file + '.tmp', metrics_file)
+
+
+# Keep-alive HTTP sessions, per Garmin domain prefix:
+http_sessions = {}
+http_sessions_lock = threading.Lock()
+
+def garmin_session(domain_prefix):
+    """
+    Return the pooled HTTP session to that Garmin domain, with the headers
+    that do not depend on the message already set.
+    """
+    with http_sessions_lock:
+        if domain_prefix not in http_sessions:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=MAX_CONCURRENT_SENDS)
+            session.mount('https://', adapter)
+            session.cookies.set('BrowsingMode', 'Desktop')
+            session.headers.update({
+                'authority': f"{domain_prefix}explore.garmin.com",
+                'accept': '*/*',
+                'accept-language': 'en-US,en;q=0.9',
+                'cache-control': 'no-cache',
+                'content-type': 'application/x-www-form-urlencoded; charset=UTF-8',
+                'cookie': 'BrowsingMode=Desktop',
+                'dnt': '1',
+                'origin': f"https://{domain_prefix}explore.garmin.com",
+                'pragma': 'no-cache',
+                'sec-ch-ua': '"Chromium";v="106", "Not;A=Brand";v="99", "Google Chrome";v="106.0.5249.119"',
+                'sec-ch-ua-mobile': '?0',
+                'sec-ch-ua-platform': '"Linux"',
+                'sec-fetch-dest': 'empty',
+                'sec-fetch-mode': 'cors',
+                'sec-fetch-site': 'same-origin',
+                'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/106.0.0.0 Safari/537.36',
+                'x-requested-with': 'XMLHttpRequest',
+            })
+            http_sessions[domain_prefix] = session
+        return http_sessions[domain_prefix]
+
+
+def drop_garmin_session(domain_prefix):
+    with http_sessions_lock:
+        session = http_sessions.pop(domain_prefix, None)
+    if session is not None:
+        session.close()
 
 
 def inreachReply(mail_conf, url, domain_prefix, message_str):
     """
     Use the URL provided by Garmin to message the sailor
     """
-    cookies = {
-        'BrowsingMode': 'Desktop',
-    }
-
     headers = {
-        'authority': f"{domain_prefix}explore.garmin.com",
-        'accept': '*/*',
-        'accept-language': 'en-US,en;q=0.9',
-        'cache-control': 'no-cache',
-        'content-type': 'application/x-www-form-urlencoded; charset=UTF-8',
-        'cookie': 'BrowsingMode=Desktop',
-        'dnt': '1',
-        'origin': f"https://{domain_prefix}explore.garmin.com",
-        'pragma': 'no-cache',
         'referer': url,
-        'sec-ch-ua': '"Chromium";v="106", "Not;A=Brand";v="99", "Google Chrome";v="106.0.5249.119"',
-        'sec-ch-ua-mobile': '?0',
-        'sec-ch-ua-platform': '"Linux"',
-        'sec-fetch-dest': 'empty',
-        'sec-fetch-mode': 'cors',
-        'sec-fetch-site': 'same-origin',
-        'user-agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/106.0.0.0 Safari/537.36',
-        'x-requested-with': 'XMLHttpRequest',
     }
 
     data = {
@@ -54,9 +173,24 @@ def inreachReply(mail_conf, url, domain_prefix, message_str):
     }
 
     logging.info("Posting a SMS...")
-    r = requests.post(f"https://{domain_prefix}explore.garmin.com/TextMessage/TxtMsg", cookies=cookies, headers=headers, data=data)
+    # The Garmin server can be replaced with 'garmin-url' (for instance to use
+    # a local server):
+    base_url = mail_conf.get('garmin-url', f"https://{domain_prefix}explore.garmin.com")
+    post_url = f"{base_url}/TextMessage/TxtMsg"
+    with timed('garmin_post'):
+        try:
+            r = garmin_session(domain_prefix).post(post_url, headers=headers, data=data)
+        except requests.exceptions.ConnectionError as e:
+            # The pooled connection may have been closed in between; retry once
+            # from a fresh session:
+            logging.warning(f"...Connection error ({e}), reconnecting")
+            count('garmin_reconnections')
+            drop_garmin_session(domain_prefix)
+            r = garmin_session(domain_prefix).post(post_url, headers=headers, data=data)
+    count('garmin_posts')
     if r.status_code != 200:
         logging.error(f"...COULD NOT SEND! RESPONSE CODE={r.status_code}")
+        count('garmin_errors')
     else:
         logging.info('...Sent!')
     return r
@@ -66,12 +200,25 @@ def send_sms_via_url(mail_conf, url, domain_prefix):
     def send_sms(part):
         logging.info(f"Sending to {url} ({domain_prefix}):\n{part}")
         res = inreachReply(mail_conf, url, domain_prefix, part)
-        time.sleep(10)  # Give inReach some time to send the SMS
+        time.sleep(SMS_DELAY)  # Give inReach some time to send the SMS
         return (res.status_code == 200)
     return send_sms
 
 
+# The authenticated SMTP connection, kept open in between messages:
+smtp_connection = None
+smtp_lock = threading.Lock()
+
+def smtp_connect(mail_conf):
+    smtp = SMTP(host=mail_conf['smtp-host'], port=mail_conf['smtp-port'])
+    if mail_conf.get('smtp-starttls', True):
+        smtp.starttls()
+    smtp.login(mail_conf['username'], mail_conf['password'])
+    return smtp
+
+
 def send_message(mail_conf, dest, text):
+    global smtp_connection
     msg_id = str(random.getrandbits(64))
     logging.info(f"...Sending an email to {dest} with id {msg_id}")
     headers = [
@@ -81,16 +228,298 @@ def send_message(mail_conf, dest, text):
         f"Message-Id: {msg_id}",
     ]
     text = "\r\n".join(headers) + "\r\n\r\n" + text
-    with SMTP(host=mail_conf['smtp-host'], port=mail_conf['smtp-port']) as smtp:
-        smtp.starttls()
-        smtp.login(mail_conf['username'], mail_conf['password'])
-        smtp.sendmail(mail_conf['email'], dest, text)
-        smtp.quit()
+    with smtp_lock, timed('smtp_send'):
+        try:
+            if smtp_connection is None:
+                smtp_connection = smtp_connect(mail_conf)
+            smtp_connection.sendmail(mail_conf['email'], dest, text)
+        except (SMTPException, OSError) as e:
+            # The server may have closed the connection in between; retry
+            # once from a new connection:
+            logging.warning(f"...SMTP error ({e}), reconnecting")
+            count('smtp_reconnections')
+            if smtp_connection is not None:
+                smtp_connection.close()
+                smtp_connection = None
+            smtp_connection = smtp_connect(mail_conf)
+            smtp_connection.sendmail(mail_conf['email'], dest, text)
     return msg_id
 
 
 GARMIN_URL_RE = re.compile("https://([a-z]*\.)?explore.garmin.com")
 
+def normalize_request(request):
+    """
+    Saildocs requests are not case sensitive and ignore spaces.
+    """
+    return re.sub(r"\s+", "", request).lower()
+
+
+#
+# Boats sailing together ask for about the same forecasts. The requests
+# waiting for Saildocs that overlap are merged into one query for the
+# smallest area and time points covering them all, and each sailor's
+# forecast is then cut out of the answer (see cut_grib).
+#
+
+# As in "gfs:25n,41n,29w,009w|2,2|12,24,36,48|wind", once normalized:
+SAILDOCS_REQUEST_RE = re.compile(
+    r"^(\w+):([\d.]+)([ns]),([\d.]+)([ns]),([\d.]+)([ew]),([\d.]+)([ew])\|([\d.]+),([\d.]+)\|(\d+(?:,\d+)*)\|(.+)$")
+
+def parse_request(request):
+    """
+    Return the area, resolution and time points of that request, or None
+    if it's not understood (it's then sent to Saildocs as is).
+    """
+    m = SAILDOCS_REQUEST_RE.match(normalize_request(request))
+    if m is None:
+        return None
+    model, lat1, ns1, lat2, ns2, lon1, ew1, lon2, ew2, latdiff, londiff, hours, params = m.groups()
+    lats = sorted(float(lat) * (-1 if ns == 's' else 1) for lat, ns in ((lat1, ns1), (lat2, ns2)))
+    lons = [ float(lon) * (-1 if ew == 'w' else 1) for lon, ew in ((lon1, ew1), (lon2, ew2)) ]
+    # Areas across the antimeridian are left alone:
+    if lons[0] > lons[1]:
+        return None
+    return {
+        'model': model,
+        'lats': lats,
+        'lons': lons,
+        'res': (float(latdiff), float(londiff)),
+        'hours': sorted(set(int(hour) for hour in hours.split(','))),
+        'params': params,
+    }
+
+
+def same_grid(a, b):
+    """
+    Tell if those requests (as parsed) can be cut out of each other: same
+    model, resolution and parameters, and points on the same grid.
+    """
+    def aligned(x, y, step):
+        return abs((x - y) / step - round((x - y) / step)) < 1e-6
+    return (a['model'], a['res'], a['params']) == (b['model'], b['res'], b['params']) and \
+        aligned(a['lats'][0], b['lats'][0], a['res'][0]) and aligned(a['lons'][0], b['lons'][0], a['res'][1])
+
+
+def covers(a, b):
+    """
+    Tell if the forecast of request a (as parsed) has all that request b
+    needs.
+    """
+    return same_grid(a, b) and \
+        a['lats'][0] <= b['lats'][0] and b['lats'][1] <= a['lats'][1] and \
+        a['lons'][0] <= b['lons'][0] and b['lons'][1] <= a['lons'][1] and \
+        set(b['hours']) <= set(a['hours'])
+
+
+def request_cost(a):
+    """
+    How many values the forecast of that request (as parsed) has.
+    """
+    return (round((a['lats'][1] - a['lats'][0]) / a['res'][0]) + 1) * \
+        (round((a['lons'][1] - a['lons'][0]) / a['res'][1]) + 1) * len(a['hours'])
+
+
+def merge_two(a, b):
+    """
+    Return the smallest request covering both a and b (as parsed), or None
+    if they can't be merged or if it would cost more than asking for both.
+    """
+    if not same_grid(a, b):
+        return None
+    if a['lats'][1] < b['lats'][0] or b['lats'][1] < a['lats'][0] or \
+       a['lons'][1] < b['lons'][0] or b['lons'][1] < a['lons'][0]:
+        return None
+    merged = {
+        **a,
+        'lats': [ min(a['lats'][0], b['lats'][0]), max(a['lats'][1], b['lats'][1]) ],
+        'lons': [ min(a['lons'][0], b['lons'][0]), max(a['lons'][1], b['lons'][1]) ],
+        'hours': sorted(set(a['hours']) | set(b['hours'])),
+    }
+    if request_cost(merged) > request_cost(a) + request_cost(b):
+        return None
+    return merged
+
+
+def format_request(a):
+    """
+    Write a request (as parsed) the way Saildocs expects it.
+    """
+    def lat(x):
+        return f"{abs(x):g}{'s' if x < 0 else 'n'}"
+    def lon(x):
+        return f"{abs(x):g}{'w' if x < 0 else 'e'}"
+    return f"{a['model']}:{lat(a['lats'][0])},{lat(a['lats'][1])},{lon(a['lons'][0])},{lon(a['lons'][1])}" + \
+        f"|{a['res'][0]:g},{a['res'][1]:g}|{','.join(str(hour) for hour in a['hours'])}|{a['params']}"
+
+
+def merge_requests(request, others):
+    """
+    Return the query to send to Saildocs for that request, merged with as
+    many of the others as possible, and the (normalized) requests it
+    answers.
+    """
+    merged = parse_request(request)
+    answered = { normalize_request(request) }
+    left = [ (normalize_request(other), parse_request(other)) for other in others ]
+    # Each merge grows the area, which may then reach some other request:
+    while merged is not None:
+        for other_key, other in left:
+            if other_key in answered or other is None:
+                continue
+            bigger = merge_two(merged, other)
+            if bigger is not None:
+                merged = bigger
+                answered.add(other_key)
+                break
+        else:
+            break
+    # The same request several times is sent as is:
+    if merged is None or len(answered) == 1:
+        return request, answered
+    return format_request(merged), answered
+
+
+def cut_request(grib, request):
+    """
+    Cut the forecast of that request out of the GRIB data of a query covering
+    it.
+    """
+    parsed = parse_request(request)
+    return cut_grib(grib, *parsed['lats'], *parsed['lons'], parsed['hours'])
+
+
+#
+# The received forecasts are kept in the state, along with the requests they
+# answer so that the same request is answered from that cache for a while.
+# A forecast is deleted once neither the cache nor any job needs it.
+#
+
+def save_grib(state, grib):
+    """
+    Save that GRIB data into the state (within the current transaction),
+    and return its key.
+    """
+    grib_key = hashlib.sha256(grib).hexdigest()
+    state.execute("INSERT OR IGNORE INTO gribs VALUES (?, ?)", (grib_key, grib))
+    return grib_key
+
+
+def load_grib(state, grib_key):
+    row = state.execute("SELECT grib FROM gribs WHERE grib_key = ?", (grib_key,)).fetchone()
+    assert row is not None, f"Forecast {grib_key} is gone"
+    return row[0]
+
+
+def forget_gribs(state):
+    """
+    Delete the forecasts that are neither cached nor used by any job (within
+    the current transaction).
+    """
+    deleted = state.execute("""
+        DELETE FROM gribs
+        WHERE grib_key NOT IN (SELECT grib_key FROM forecasts)
+          AND grib_key NOT IN (
+            SELECT json_extract(args, '$.grib_key') FROM jobs
+            WHERE json_extract(args, '$.grib_key') IS NOT NULL)""").rowcount
+    if deleted > 0:
+        logging.debug(f"...Deleted {deleted} forecasts no longer needed")
+
+
+def evict_cache(state, now):
+    """
+    Forget the forecasts older than CACHE_TTL, then the least recently used
+    ones until the total size fits in CACHE_MAX_SIZE (within the current
+    transaction).
+    """
+    evicted = state.execute("DELETE FROM forecasts WHERE time_cached < ?", (now - CACHE_TTL,)).rowcount
+    rows = state.execute("SELECT request_key, grib_key, size FROM forecasts ORDER BY last_used DESC").fetchall()
+    total_size = 0
+    for request_key, grib_key, size in rows:
+        total_size += size
+        if total_size > CACHE_MAX_SIZE:
+            state.execute("DELETE FROM forecasts WHERE request_key = ? AND grib_key = ?", (request_key, grib_key))
+            evicted += 1
+    if evicted > 0:
+        logging.info(f"...Evicted {evicted} forecasts from the cache")
+        forget_gribs(state)
+
+
+def cache_forecast(state, request, grib, time_cached=None):
+    """
+    Remember that this GRIB data answers that request, and return its key
+    (within the current transaction, so that a job using it can be added
+    before it's evicted).
+    time_cached is when the forecast was received, if not now (for the
+    forecasts cut out of another one, that must not outlive it).
+    """
+    now = time.time()
+    grib_key = save_grib(state, grib)
+    state.execute(
+        "INSERT OR REPLACE INTO forecasts VALUES (?, ?, ?, ?, ?, ?)",
+        (normalize_request(request), grib_key, str(read_run_time(grib)), len(grib), time_cached or now, now))
+    return grib_key
+
+
+def lookup_cache(state, request):
+    """
+    Return the request and key of the forecast of the latest model run
+    answering that request (that very request preferably, or one covering
+    it), if it is still fresh, or None.
+    """
+    now = time.time()
+    parsed = parse_request(request)
+    with state:
+        evict_cache(state, now)
+        hits = []
+        for request_key, grib_key, run_time in state.execute("SELECT request_key, grib_key, run_time FROM forecasts").fetchall():
+            exact = request_key == normalize_request(request)
+            cached = parse_request(request_key)
+            if exact or (parsed is not None and cached is not None and covers(cached, parsed)):
+                hits.append((run_time, exact, request_key, grib_key))
+        if not hits:
+            return None
+        _, _, request_key, grib_key = max(hits)
+        state.execute(
+            "UPDATE forecasts SET last_used = ? WHERE request_key = ? AND grib_key = ?",
+            (now, request_key, grib_key))
+    return request_key, grib_key
+
+
+def archive_grib(fname, grib):
+    """
+    Save a copy of that GRIB data into ATTACHMENTS_PATH, deleting the oldest
+    files there beyond ATTACHMENTS_MAX_SIZE.
+    """
+    pathlib.Path(ATTACHMENTS_PATH).mkdir(parents=True, exist_ok=True)
+    grib_path = os.path.join(ATTACHMENTS_PATH, fname)
+    with open(grib_path, 'wb') as f:
+        f.write(grib)
+    logging.info(f"...Archived grib file into {grib_path}")
+    files = sorted(
+        (entry for entry in os.scandir(ATTACHMENTS_PATH) if entry.is_file()),
+        key=lambda entry: entry.stat().st_mtime, reverse=True)
+    total_size = 0
+    for entry in files:
+        total_size += entry.stat().st_size
+        if total_size > ATTACHMENTS_MAX_SIZE:
+            logging.info(f"...Deleting {entry.path} from the archive")
+            os.remove(entry.path)
+
+
+# A forecast request can end with the maximum number of messages to send it
+# in, as in "gfs:25n,41n,29w,009w|2,2|12,24,36,48|wind max 10":
+BUDGET_RE = re.compile(r"^(.*?)\s+max\s*[:=]?\s*(\d+)$", re.IGNORECASE)
+
+def parts_budget(mail_conf, max_parts):
+    """
+    Return how many parts a forecast can be sent in, given that sailor's
+    budget (if any) and the one of the service (if any).
+    """
+    budgets = [ budget for budget in (max_parts, mail_conf.get('max-parts')) if budget is not None ]
+    return min(budgets) if budgets else None
+
+
 def handle_weather_request(state, mail_conf, msg):
     """
     Request a weather forecast on behalf of that sailor.
@@ -107,53 +536,474 @@ def handle_weather_request(state, mail_conf, msg):
 
     if 'url' not in req:
         logging.error(f"...CANNOT FIND GARMIN URL IN:\n{msg.text}\n")
-        return
+        return state
 
     logging.info(f"...Will send using url:{req['url']} and domain_prefix:{req['domain_prefix']}")
 
     # If we could find the URL there is at least one line:
     first_line = lines[0]
+    if RESEND_RE.match(first_line):
+        handle_resend_request(state, mail_conf, req, first_line)
     # Only allows for ECMWF or GFS model:
-    if first_line[:5] == 'ecmwf' or first_line[:3] == 'gfs':
-        # Sends message to saildocs according to their formatting:
-        req['message-id'] = send_message(mail_conf, "query@saildocs.com", "send " + first_line)
+    elif first_line[:5] == 'ecmwf' or first_line[:3] == 'gfs':
+        m = BUDGET_RE.match(first_line)
+        if m is not None:
+            first_line, req['max_parts'] = m.group(1), int(m.group(2))
+            logging.info(f"...At most {req['max_parts']} messages wanted")
         req['request'] = first_line
-        req['time_sent'] = str(datetime.utcnow())
-        state.append(req)
+        req['time_sent'] = time.time()
+        hit = lookup_cache(state, first_line)
+        if hit is not None:
+            count('cache_hits')
+            query, grib_key = hit
+            logging.info(f"...Forecast found in cache: {query}")
+            add_request(state, { **req, 'query_key': query })
+            add_job(state, 'forward', { 'request': query, 'grib_key': grib_key })
+        else:
+            add_request(state, req)
+            query = find_query(state, req)
+            if query is not None:
+                count('merged_requests')
+                logging.info(f"...Will be answered by the pending query {query}")
+            else:
+                count('cache_misses')
+                add_job(state, 'query', req)
     else:
         print(f"...CANNOT FIND PROPER WEATHER REQUEST IN '{first_line}', SENDING BACK AN ERROR MESSAGE!", flush=True)
-        inreachReply(mail_conf, req['url'], req['domain_prefix'], f"""
+        add_job(state, 'reply', { **req, 'text': f"""
 Cannot make sense of the forecast request. :-(
 The forecasst request must be on the first line and look something like:
   ecmwf:25n,41n,29w,009w|2,2|12,24,36,48|wind
 
 Your first line was:
   {first_line}
-""")
+""" })
 
     return state
 
 
-def forward_forecast(state, mail_conf, request, time_recvd, grib_path):
+RESEND_RE = re.compile(r"^resend\b\s*([0-9,\s]*)$", re.IGNORECASE)
+
+def handle_resend_request(state, mail_conf, req, first_line):
     """
-    Forward that grib file to each sailor who wanted it, and remove
-    those requests from the state.
+    Send again some parts (or all if none are given) of the last forecast
+    sent to that sailor, as in: "resend 3,5".
     """
-    to_send = set()
-    new_state = []
-    for req in state:
-        if req['request'] == request:
-            # TODO: once we trust the dates, don't send if req['time_sent'] > time_recvd
-            to_send.add((req['url'], req['domain_prefix']))
-        else:
-            logging.debug(f"...not for this sailor: {req['request']} != {request}")
-            new_state.append(req)
+    part_nos = [ int(n) for n in re.split(r"[,\s]+", RESEND_RE.match(first_line).group(1)) if n ]
+    parts = sent_parts(state, req['url'], part_nos)
+    if len(parts) == 0:
+        logging.error(f"...NO RECENT FORECAST SENT TO {req['url']}")
+        add_job(state, 'reply', { **req, 'text': "No recent forecast to resend, sorry." })
+        return
+    missing = set(part_nos) - set(parts)
+    if missing:
+        logging.warning(f"...Parts {sorted(missing)} were never sent to {req['url']}")
+    logging.info(f"...Will resend parts {sorted(parts)} to {req['url']}")
+    add_job(state, 'resend', { **req, 'parts': [ parts[part_no] for part_no in sorted(parts) ] })
+
+
+#
+# Jobs
+#
+# Reading the mails only queues jobs: querying Saildocs, encoding a forecast
+# that just came in, sending it to each sailor... Each kind of job is run in
+# the background by its own pool of workers, so that new mails are read
+# while forecasts are being sent. Jobs are saved in the state until they are
+# done, sends saving their progress after each part, so that they resume
+# after a restart.
+#
 
+# Pools of workers, and how many workers each has:
+JOB_POOLS = {
+    'saildocs': SAILDOCS_WORKERS,
+    'encode': ENCODE_WORKERS,
+    'garmin': MAX_CONCURRENT_SENDS,
+}
+jobs = {
+    'queues': { pool: queue.Queue() for pool in JOB_POOLS },
+    'stop': threading.Event(),
+    'workers': [],
+    'mail_conf': None,
+    # The bigram model shared by all sends (see read_bigram_model):
+    'model': None,
+    # Per sailor (url) with a Garmin job queued or running, their next jobs,
+    # run one after the other so that their parts are not interleaved (see
+    # queue_job):
+    'sailors': {},
+    'sailors_lock': threading.Lock(),
+}
+
+
+def run_query(state, mail_conf, job):
+    """
+    Send a forecast request to Saildocs on behalf of a sailor, merged with
+    the other requests waiting for Saildocs it overlaps, once it waited
+    QUERY_DELAY for them. Returns False if interrupted by stop_workers.
+    """
+    req = job['args']
+    if jobs['stop'].wait(job['time_queued'] + QUERY_DELAY - time.time()):
+        return False
+    # The query is saved with the job, to be sent again if that failed:
+    if 'query' not in req:
+        with state:
+            state.execute("BEGIN IMMEDIATE")
+            req['query'] = assign_query(state, req['request'])
+            state.execute("UPDATE jobs SET args = ? WHERE job_id = ?", (json.dumps(req), job['job_id']))
+    query = req['query']
+    if query is None:
+        logging.info(f"...Request {req['request']} was merged into another query")
+        return True
+    if normalize_request(query) != normalize_request(req['request']):
+        logging.info(f"...Merged requests into query {query}")
+    # Sends message to saildocs according to their formatting:
+    msg_id = send_message(mail_conf, "query@saildocs.com", "send " + query)
+    set_message_id(state, query, msg_id)
+    count('saildocs_queries')
+    return True
+
+
+def run_forward(state, mail_conf, job):
+    """
+    Cut out of that forecast the one of each sailor who wanted it (when the
+    query merged several requests) and encode it, then replace those
+    requests with the jobs sending it to them.
+    """
+    query = job['args']['request']
+    grib = load_grib(state, job['args']['grib_key'])
+    version = mail_conf.get('format-version', 1)
+    # Per (normalized) request, its forecast:
+    gribs = { normalize_request(query): grib }
+    def grib_of(request):
+        if normalize_request(request) not in gribs:
+            try:
+                with timed('cut'):
+                    gribs[normalize_request(request)] = cut_request(grib, request)
+            except Exception:
+                # Rather send the whole forecast than nothing:
+                logging.error(f"...CANNOT CUT {request} OUT OF THE FORECAST OF {query}, SENDING IT ALL:")
+                logging.error(traceback.format_exc())
+                count('cut_failures')
+                gribs[normalize_request(request)] = grib
+        return gribs[normalize_request(request)]
+    # Read and encode each forecast once for all the sailors with the same
+    # budget (see cached_payload), unless it's encoded for each send as a
+    # stream:
+    if not mail_conf.get('stream-encode', False):
+        with timed('encode'):
+            for request, max_parts in pending_budgets(state, query):
+                budget_payload(grib_of(request), version, parts_budget(mail_conf, max_parts))
+    with state:
+        state.execute("BEGIN IMMEDIATE")
+        # The forecasts cut out are cached as answering their own request,
+        # until the forecast they come from expires:
+        grib_keys = { normalize_request(query): job['args']['grib_key'] }
+        time_cached, = state.execute(
+            "SELECT MIN(time_cached) FROM forecasts WHERE grib_key = ?", (job['args']['grib_key'],)).fetchone()
+        to_send = []
+        for request, url, domain_prefix, time_sent, max_parts in pop_requests(state, query):
+            if normalize_request(request) not in grib_keys:
+                if grib_of(request) is grib:
+                    grib_keys[normalize_request(request)] = job['args']['grib_key']
+                elif time_cached is None:
+                    grib_keys[normalize_request(request)] = save_grib(state, grib_of(request))
+                else:
+                    grib_keys[normalize_request(request)] = cache_forecast(state, request, grib_of(request), time_cached)
+            to_send.append(insert_job(state, 'send', {
+                'request': request,
+                'grib_key': grib_keys[normalize_request(request)],
+                'url': url,
+                'domain_prefix': domain_prefix,
+                'time_sent': time_sent,
+                'max_parts': parts_budget(mail_conf, max_parts),
+                'progress': new_progress(),
+                'sent': [],
+                'failed_parts': 0,
+            }))
     logging.info(f"...Forward the attachment to {len(to_send)} sailors!")
-    for url, domain_prefix in to_send:
-        encode(grib_path, send_sms_via_url(mail_conf, url, domain_prefix))
+    for send_job in to_send:
+        queue_job(send_job)
+    return True
 
-    return new_state
+
+def run_send(state, mail_conf, job):
+    """
+    Send a forecast to one sailor, part after part, saving the progress
+    after each one. Returns False if interrupted by stop_workers.
+    """
+    args = job['args']
+    url = args['url']
+    version = mail_conf.get('format-version', 1)
+    send_sms = send_sms_via_url(mail_conf, url, args['domain_prefix'])
+    req = { 'request': args['request'], 'url': url, 'time_requested': args['time_sent'], 'max_parts': args['max_parts'] }
+    if 'time_started' not in args:
+        args['time_started'] = time.time()
+        record_time('wait_forecast', args['time_started'] - args['time_sent'])
+    req['waited_s'] = args['time_started'] - args['time_sent']
+    grib = load_grib(state, args['grib_key'])
+    payload = budget_payload(grib, version, args['max_parts'], mail_conf.get('stream-encode', False))
+    req['reduction'] = payload['reduction']
+    if args['max_parts'] is not None:
+        logging.info(f"...Sending at most {args['max_parts']} parts to {url}, with reduction {req['reduction']}")
+    if args['progress']['part_no'] > 0:
+        logging.info(f"...Resuming the forecast to {url} from part {args['progress']['part_no']}")
+    parts = payload_parts(payload, jobs['model'], args['progress'])
+    try:
+        part = next(parts)
+        while not jobs['stop'].is_set():
+            success = send_sms(part)
+            if success:
+                args['sent'].append(part)
+            else:
+                # Will be retried with another shift:
+                args['failed_parts'] += 1
+            count('sent_parts' if success else 'failed_parts')
+            try:
+                part = parts.send(success)
+            finally:
+                update_job(state, job['job_id'], args)
+        return False
+    except StopIteration as done:
+        req['success'] = done.value
+    save_sent_parts(state, url, args['sent'])
+    save_bigram_model(BIGRAMS_FILE, jobs['model'])
+    req['failed_parts'] = args['failed_parts']
+    req['parts'] = len(args['sent'])
+    req['send_s'] = time.time() - args['time_started']
+    req['total_s'] = time.time() - args['time_sent']
+    record_time('send_forecast', req['send_s'])
+    record_time('request_to_last_part', req['total_s'])
+    record_request(req)
+    if req['success']:
+        logging.info(f"...Forecast sent to {url}")
+        count('forecasts_sent')
+    else:
+        logging.error(f"...COULD NOT SEND FORECAST TO {url}!")
+        count('forecasts_failed')
+    return True
+
+
+def run_resend(state, mail_conf, job):
+    """
+    Send again some parts of the last forecast sent to a sailor.
+    Returns False if interrupted by stop_workers.
+    """
+    args = job['args']
+    send_sms = send_sms_via_url(mail_conf, args['url'], args['domain_prefix'])
+    while args['parts']:
+        if jobs['stop'].is_set():
+            return False
+        # Only forgotten once sent, to be sent again if that fails:
+        if send_sms(args['parts'][0]):
+            count('resent_parts')
+        else:
+            # Sent as it was the first time, so no other shift to try:
+            logging.warning(f"...Could not send again to {args['url']}:\n{args['parts'][0]}")
+            count('failed_resent_parts')
+        args['parts'].pop(0)
+        update_job(state, job['job_id'], args)
+    return True
+
+
+def run_reply(state, mail_conf, job):
+    """
+    Answer a sailor with a plain text message.
+    """
+    args = job['args']
+    inreachReply(mail_conf, args['url'], args['domain_prefix'], args['text'])
+    return True
+
+
+def give_up_query(state, job):
+    """
+    Forget the requests waiting for a query that could not be sent to
+    Saildocs, rather than having them wait for it until STATE_TTL.
+    """
+    query = job['args'].get('query')
+    if query is not None:
+        with state:
+            forgotten = state.execute(
+                "DELETE FROM requests WHERE query_key = ? AND message_id IS NULL",
+                (normalize_request(query),)).rowcount
+        logging.error(f"...COULD NOT SEND QUERY {query}, forgot {forgotten} requests!")
+
+
+def give_up_forward(state, job):
+    """
+    Forget the requests waiting for a forecast that could not be forwarded,
+    rather than having them wait for another one until STATE_TTL.
+    """
+    query = job['args']['request']
+    with state:
+        forgotten = state.execute(
+            f"DELETE FROM requests WHERE {QUERY_REQUESTS}",
+            (normalize_request(query),) * 2).rowcount
+    logging.error(f"...COULD NOT FORWARD THE FORECAST OF {query}, forgot {forgotten} requests!")
+
+
+def give_up_send(state, job):
+    """
+    Keep the parts of a forecast that could be sent before giving up on it,
+    so that the sailor can still have them sent again.
+    """
+    args = job['args']
+    save_sent_parts(state, args['url'], args['sent'])
+    logging.error(f"...COULD NOT SEND FORECAST TO {args['url']}!")
+    count('forecasts_failed')
+
+
+# Per kind of job, the pool of workers running it and how, and what to do
+# when giving up on it:
+JOB_KINDS = {
+    'query': ('saildocs', run_query, give_up_query),
+    'forward': ('encode', run_forward, give_up_forward),
+    'send': ('garmin', run_send, give_up_send),
+    'resend': ('garmin', run_resend, None),
+    'reply': ('garmin', run_reply, None),
+}
+
+
+def insert_job(state, kind, args):
+    """
+    Save a new job into the state (within the current transaction), and
+    return it, to be given to queue_job once committed.
+    """
+    time_queued = time.time()
+    job_id = state.execute(
+        "INSERT INTO jobs (kind, args, time_queued) VALUES (?, ?, ?)",
+        (kind, json.dumps(args), time_queued)).lastrowid
+    return { 'job_id': job_id, 'kind': kind, 'args': args, 'time_queued': time_queued, 'attempts': 0 }
+
+
+def queue_job(job):
+    """
+    Queue that job for its pool of workers, or, if it's for a sailor who
+    already has a job queued or running, after that one (see release_job).
+    """
+    pool, _, _ = JOB_KINDS[job['kind']]
+    if pool == 'garmin':
+        with jobs['sailors_lock']:
+            url = job['args']['url']
+            if url in jobs['sailors']:
+                jobs['sailors'][url].append(job)
+                return
+            jobs['sailors'][url] = collections.deque()
+    jobs['queues'][pool].put(job)
+
+
+def release_job(job):
+    """
+    Queue the next job of the sailor that job was for, now that it's done.
+    """
+    pool, _, _ = JOB_KINDS[job['kind']]
+    if pool == 'garmin':
+        with jobs['sailors_lock']:
+            url = job['args']['url']
+            if jobs['sailors'][url]:
+                jobs['queues'][pool].put(jobs['sailors'][url].popleft())
+            else:
+                del jobs['sailors'][url]
+
+
+def add_job(state, kind, args):
+    with state:
+        job = insert_job(state, kind, args)
+    queue_job(job)
+
+
+def update_job(state, job_id, args):
+    with state:
+        state.execute("UPDATE jobs SET args = ? WHERE job_id = ?", (json.dumps(args), job_id))
+
+
+def retry_job(state, job):
+    """
+    Count a failed attempt at that job, and return whether it's to be tried
+    again, in which case it's queued again once the delay has passed.
+    The job stays in the state meanwhile, to be resumed by the next run if
+    the service stops before, and the next jobs of the same sailor wait for
+    it.
+    """
+    job['attempts'] += 1
+    with state:
+        state.execute("UPDATE jobs SET attempts = ? WHERE job_id = ?", (job['attempts'], job['job_id']))
+    if job['attempts'] >= JOB_MAX_ATTEMPTS:
+        return False
+    delay = JOB_RETRY_DELAY * 2**(job['attempts'] - 1)
+    logging.info(f"...Trying job {job['job_id']} again in {delay:.0f}s")
+    pool, _, _ = JOB_KINDS[job['kind']]
+    timer = threading.Timer(delay, jobs['queues'][pool].put, (job,))
+    timer.daemon = True
+    timer.start()
+    return True
+
+
+def delete_job(state, job_id):
+    with state:
+        state.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,))
+        forget_gribs(state)
+
+
+def run_jobs(state_file, pool):
+    """
+    Run the jobs of that pool as they are queued, until stop_workers.
+    """
+    state = connect_state(state_file)
+    mail_conf = jobs['mail_conf']
+    while not jobs['stop'].is_set():
+        try:
+            job = jobs['queues'][pool].get(timeout=1)
+        except queue.Empty:
+            continue
+        if job['attempts'] == 0:
+            record_time(f"queued_{pool}", time.time() - job['time_queued'])
+        _, run, give_up = JOB_KINDS[job['kind']]
+        try:
+            done = run(state, mail_conf, job)
+        except Exception:
+            logging.error(f"JOB {job['job_id']} ({job['kind']}) FAILED (attempt {job['attempts'] + 1} of {JOB_MAX_ATTEMPTS}):")
+            logging.error(traceback.format_exc())
+            count('job_errors')
+            done = not retry_job(state, job)
+            if done:
+                logging.error(f"GIVING UP ON JOB {job['job_id']} ({job['kind']})")
+                count('jobs_given_up')
+                if give_up is not None:
+                    give_up(state, job)
+        if done:
+            delete_job(state, job['job_id'])
+            release_job(job)
+        save_metrics(METRICS_FILE)
+    state.close()
+
+
+def start_workers(state, state_file, mail_conf):
+    """
+    Queue the jobs left over from a previous run, and start the workers.
+    """
+    jobs['mail_conf'] = mail_conf
+    jobs['model'] = read_bigram_model(BIGRAMS_FILE)
+    rows = state.execute("SELECT job_id, kind, args, time_queued, attempts FROM jobs ORDER BY job_id").fetchall()
+    if rows:
+        logging.info(f"Resuming {len(rows)} jobs")
+    for job_id, kind, args, time_queued, attempts in rows:
+        queue_job({ 'job_id': job_id, 'kind': kind, 'args': json.loads(args), 'time_queued': time_queued, 'attempts': attempts })
+    for pool, num_workers in JOB_POOLS.items():
+        for _ in range(num_workers):
+            worker = threading.Thread(target=run_jobs, args=(state_file, pool), daemon=True)
+            worker.start()
+            jobs['workers'].append(worker)
+
+
+def stop_workers():
+    """
+    Have the workers stop after the part they are sending, leaving the
+    unfinished jobs in the state for the next run.
+    """
+    jobs['stop'].set()
+    for worker in jobs['workers']:
+        worker.join()
+    if jobs['model'] is not None:
+        save_bigram_model(BIGRAMS_FILE, jobs['model'])
 
 
 def handle_weather_answer(state, mail_conf, msg):
@@ -182,12 +1032,15 @@ def handle_weather_answer(state, mail_conf, msg):
         if ext != '.grb':
             continue
         logging.info(f"...Find forecast for {request} in {att.filename} of type {att.content_type}")
-        grib_path = ATTACHMENTS_PATH + '/' + fname
-        pathlib.Path(ATTACHMENTS_PATH).mkdir(parents=True, exist_ok=True)
-        with open(grib_path, 'wb') as f:
-            f.write(att.part.get_payload(decode=True))
-        logging.info(f"...Saved grib file into {grib_path}")
-        state = forward_forecast(state, mail_conf, request, time_recvd, grib_path)
+        grib = att.part.get_payload(decode=True)
+        if ATTACHMENTS_PATH:
+            archive_grib(fname, grib)
+        # TODO: once we trust the dates, don't send if req['time_sent'] > time_recvd
+        with state:
+            grib_key = cache_forecast(state, request, grib)
+            job = insert_job(state, 'forward', { 'request': request, 'grib_key': grib_key })
+            evict_cache(state, time.time())
+        queue_job(job)
         processed = True
 
     if not processed:
@@ -201,7 +1054,7 @@ def answer_service(state, mail_conf, msg):
     Answer the mail:
     - If that's a weather request, actually perform the request.
     - If it's a weather response, forward it to the sailor.
-    For this, store a state in RAM.
+    For this, store the pending requests in the state (see open_state).
     """
     logging.info(f"Answering mail which msg-id is {msg.uid}")
     is_from_garmin = (
@@ -219,49 +1072,361 @@ def answer_service(state, mail_conf, msg):
     return state
 
 
+def open_mailbox(mail_conf):
+    """
+    Log in to the IMAP server. The port and whether to use SSL can be set
+    with 'imap-port' and 'imap-ssl' (for instance to use a local server).
+    """
+    if mail_conf.get('imap-ssl', True):
+        mailbox = MailBox(mail_conf['imap-host'], port=mail_conf.get('imap-port', 993))
+    else:
+        mailbox = MailBoxUnencrypted(mail_conf['imap-host'], port=mail_conf.get('imap-port', 143))
+    return mailbox.login(mail_conf['username'], mail_conf['password'], mail_conf['folder'])
+
+
+def answer_unseen(state, mail_conf, mailbox):
+    """
+    Answer all unseen messages of that mailbox.
+    """
+    had_mail = False
+    messages = mailbox.fetch(AND(seen=False))
+    while True:
+        # Time each fetch apart from the handling of the message:
+        with timed('imap_fetch'):
+            msg = next(messages, None)
+        if msg is None:
+            break
+        had_mail = True
+        count('mails')
+        print(f"New email: Subject:{msg.subject}, Date:{msg.date_str}", flush=True)
+        try:
+            with timed('answer_mail'):
+                state = answer_service(state, mail_conf, msg)
+        except Exception as e:
+            logging.error("CANNOT ANSWER EMAIL!")
+            logging.error(traceback.format_exc())
+            count('mail_errors')
+        save_metrics(METRICS_FILE)
+    if not had_mail:
+        logging.debug("No new mails.")
+    return state
+
+
 def check_mail(state, mail_conf):
     """
     Check the inbox for unseen Garmin InReach messages.
     """
-    had_mail = False
     try:
-        with MailBox(mail_conf['imap-host']).login(mail_conf['username'], mail_conf['password'], mail_conf['folder']) as mailbox:
-            for msg in mailbox.fetch(AND(seen=False)):
-                had_mail = True
-                print(f"New email: Subject:{msg.subject}, Date:{msg.date_str}", flush=True)
-                try:
-                    state = answer_service(state, mail_conf, msg)
-                except Exception as e:
-                    logging.error("CANNOT ANSWER EMAIL!")
-                    logging.error(traceback.format_exc())
-        if not had_mail:
-            logging.debug("No new mails.")
+        with open_mailbox(mail_conf) as mailbox:
+            state = answer_unseen(state, mail_conf, mailbox)
     except Exception as e:
         logging.error(f"CANNOT READ MAILBOX: {e}, more luck next time?")
 
     return state
 
 
-def read_state(state_file):
-    if os.path.exists(state_file):
-        with open(state_file, 'r') as f:
+# RFC2177 advises to re-issue IDLE at least every 29 minutes:
+MAX_IDLE_DELAY = 29 * 60
+
+def idle_loop(args, mail_conf, state):
+    """
+    Keep one IMAP session open and answer new messages as soon as the server
+    notifies them (IMAP IDLE), reconnecting whenever the session is lost.
+    Returns False if the server does not support IDLE, True once args.count
+    wake-ups have been handled.
+    """
+    num_loops = 0
+    while(args.count <= 0 or num_loops < args.count):
+        try:
+            with open_mailbox(mail_conf) as mailbox:
+                if 'IDLE' not in mailbox.client.capabilities:
+                    logging.warning("IMAP server does not support IDLE, falling back to polling")
+                    return False
+                while(args.count <= 0 or num_loops < args.count):
+                    num_loops += 1
+                    state = answer_unseen(state, mail_conf, mailbox)
+                    state = timeout_state(state)
+                    # Wakes up as soon as the server notifies some change, or
+                    # after the long delay to expire old requests:
+                    responses = mailbox.idle.wait(timeout=min(args.long_delay, MAX_IDLE_DELAY))
+                    logging.debug(f"IDLE responses: {responses}")
+        except Exception as e:
+            logging.error(f"LOST IMAP SESSION: {e}, reconnecting...")
+            time.sleep(args.short_delay)
+    return True
+
+
+#
+# The state is the set of forecast requests waiting for Saildocs' answer,
+# kept in an SQLite database indexed by (normalized) request and URL so that
+# it survives restarts and is updated one request at a time.
+#
+
+def connect_state(state_file):
+    """
+    Open a new connection to the state, each thread using its own.
+    """
+    state = sqlite3.connect(state_file, check_same_thread=False)
+    # Write-ahead logging keeps the database consistent if we are killed:
+    state.execute("PRAGMA journal_mode=WAL")
+    state.execute("PRAGMA synchronous=NORMAL")
+    return state
+
+
+def open_state(state_file):
+    state = connect_state(state_file)
+    with state:
+        state.execute("""
+            CREATE TABLE IF NOT EXISTS requests (
+              request_key TEXT NOT NULL,
+              request TEXT NOT NULL,
+              url TEXT NOT NULL,
+              domain_prefix TEXT,
+              message_id TEXT,
+              time_sent REAL NOT NULL,
+              max_parts INTEGER,
+              query_key TEXT,
+              PRIMARY KEY (request_key, url))""")
+        # Those columns were added later on:
+        columns = [ row[1] for row in state.execute("PRAGMA table_info(requests)") ]
+        if 'max_parts' not in columns:
+            state.execute("ALTER TABLE requests ADD COLUMN max_parts INTEGER")
+        if 'query_key' not in columns:
+            state.execute("ALTER TABLE requests ADD COLUMN query_key TEXT")
+            # The requests already sent to Saildocs were sent as is:
+            state.execute("UPDATE requests SET query_key = request_key WHERE message_id IS NOT NULL")
+        state.execute("CREATE INDEX IF NOT EXISTS requests_time_sent ON requests (time_sent)")
+        # The parts of the last forecast sent to each sailor:
+        state.execute("""
+            CREATE TABLE IF NOT EXISTS sent_parts (
+              url TEXT NOT NULL,
+              part_no INTEGER NOT NULL,
+              part TEXT NOT NULL,
+              time_sent REAL NOT NULL,
+              PRIMARY KEY (url, part_no))""")
+        state.execute("CREATE INDEX IF NOT EXISTS sent_parts_time_sent ON sent_parts (time_sent)")
+        # The jobs not done yet (see run_jobs), with their arguments as JSON
+        # and how many times they failed (see retry_job):
+        state.execute("""
+            CREATE TABLE IF NOT EXISTS jobs (
+              job_id INTEGER PRIMARY KEY AUTOINCREMENT,
+              kind TEXT NOT NULL,
+              args TEXT NOT NULL,
+              time_queued REAL NOT NULL,
+              attempts INTEGER NOT NULL DEFAULT 0)""")
+        if 'attempts' not in [ row[1] for row in state.execute("PRAGMA table_info(jobs)") ]:
+            state.execute("ALTER TABLE jobs ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+        # The received forecasts, per hash of their content (see save_grib):
+        state.execute("""
+            CREATE TABLE IF NOT EXISTS gribs (
+              grib_key TEXT PRIMARY KEY,
+              grib BLOB NOT NULL)""")
+        # The requests each forecast answers (see lookup_cache):
+        state.execute("""
+            CREATE TABLE IF NOT EXISTS forecasts (
+              request_key TEXT NOT NULL,
+              grib_key TEXT NOT NULL,
+              run_time TEXT NOT NULL,
+              size INTEGER NOT NULL,
+              time_cached REAL NOT NULL,
+              last_used REAL NOT NULL,
+              PRIMARY KEY (request_key, grib_key))""")
+    migrate_json_state(state, os.path.splitext(state_file)[0] + '.json')
+    migrate_grib_paths(state)
+    logging.debug(f"{count_requests(state)} forecast requests pending in {state_file}")
+    return state
+
+
+def migrate_json_state(state, json_file):
+    """
+    Import the requests of the former JSON state file, if any.
+    """
+    if not os.path.exists(json_file):
+        return
+    with open(json_file, 'r') as f:
+        try:
+            reqs = json.load(f)
+        except json.decoder.JSONDecodeError:
+            print(f"CANNOT PARSE STATE FILE {json_file}, IGNORING IT!", flush=True)
+            reqs = []
+    for req in reqs:
+        add_request(state, { **req, 'time_sent': time.time() })
+    os.rename(json_file, json_file + '.migrated')
+    logging.info(f"Imported {len(reqs)} forecast requests from {json_file}")
+
+
+def migrate_grib_paths(state):
+    """
+    Move into the state the forecasts of the jobs saved when forecasts were
+    files.
+    """
+    rows = state.execute("SELECT job_id, args FROM jobs WHERE json_extract(args, '$.grib_path') IS NOT NULL").fetchall()
+    with state:
+        for job_id, args in rows:
+            args = json.loads(args)
             try:
-                state = json.load(f)
-                logging.debug(f"Reading {len(state)} forecast requests from {state_file}")
-                return state
-            except json.decoder.JSONDecodeError:
-                print(f"CANNOT PARSE STATE FILE {state_file}, STARTING FROM SCRATCH!", flush=True)
-    return []
+                with open(args.pop('grib_path'), 'rb') as f:
+                    args['grib_key'] = save_grib(state, f.read())
+            except OSError as e:
+                logging.error(f"CANNOT READ THE FORECAST OF JOB {job_id}: {e}")
+            state.execute("UPDATE jobs SET args = ? WHERE job_id = ?", (json.dumps(args), job_id))
+    if rows:
+        logging.info(f"Moved the forecasts of {len(rows)} jobs into the state")
+
+
+def add_request(state, req):
+    with state:
+        state.execute(
+            "INSERT OR REPLACE INTO requests VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+            (normalize_request(req['request']), req['request'], req['url'],
+             req['domain_prefix'], req.get('message-id'), req['time_sent'],
+             req.get('max_parts'), req.get('query_key')))
 
 
-def save_state(state_file, state):
-    logging.debug(f"Saving {len(state)} forecast requests into {state_file}")
-    with open(state_file, 'w+') as f:
-        json.dump(state, f, indent=2)
+def set_query(state, req, query):
+    """
+    Have that request answered by the forecast of that query (within the
+    current transaction).
+    """
+    state.execute(
+        "UPDATE requests SET query_key = ? WHERE request_key = ? AND url = ?",
+        (normalize_request(query), normalize_request(req['request']), req['url']))
+
+
+def find_query(state, req):
+    """
+    Have that request answered by a query to Saildocs already made and
+    covering it, if any, and return that query (or None).
+    """
+    parsed = parse_request(req['request'])
+    if parsed is None:
+        return None
+    with state:
+        state.execute("BEGIN IMMEDIATE")
+        rows = state.execute("SELECT DISTINCT query_key FROM requests WHERE query_key IS NOT NULL").fetchall()
+        for query_key, in rows:
+            query = parse_request(query_key)
+            if query is not None and covers(query, parsed):
+                set_query(state, req, query_key)
+                return query_key
+    return None
+
+
+def assign_query(state, request):
+    """
+    Choose the query to send to Saildocs for that request, merged with the
+    other requests waiting for their query (see merge_requests), and
+    return it, or None if the request already has its query (or is gone).
+    To be called within a transaction, so that each request gets only one.
+    """
+    rows = state.execute("SELECT DISTINCT request_key, request FROM requests WHERE query_key IS NULL").fetchall()
+    if normalize_request(request) not in (request_key for request_key, _ in rows):
+        return None
+    query, answered = merge_requests(request, [ other for _, other in rows ])
+    state.executemany(
+        "UPDATE requests SET query_key = ? WHERE query_key IS NULL AND request_key = ?",
+        [ (normalize_request(query), request_key) for request_key in answered ])
+    return query
+
+
+def set_message_id(state, query, msg_id):
+    """
+    Remember the id of the mail sent to Saildocs for that query, for the
+    requests still waiting for it.
+    """
+    with state:
+        state.execute(
+            "UPDATE requests SET message_id = ? WHERE query_key = ?",
+            (msg_id, normalize_request(query)))
+
+
+# The requests answered by the forecast of a query, including those for that
+# very forecast that were not sent yet:
+QUERY_REQUESTS = "(query_key = ? OR (query_key IS NULL AND request_key = ?))"
+
+def pending_budgets(state, query):
+    """
+    Return the (request, max_parts) of the sailors waiting for the forecast
+    of that query, with their budget (see parts_budget).
+    """
+    return state.execute(
+        f"SELECT DISTINCT request, max_parts FROM requests WHERE {QUERY_REQUESTS}",
+        (normalize_request(query),) * 2).fetchall()
+
+
+def pop_requests(state, query):
+    """
+    Remove from the state the requests answered by the forecast of that
+    query, and return the set of (request, url, domain_prefix, time_sent,
+    max_parts) to send it to.
+    To be called within a transaction, so that the requests are replaced
+    with the jobs sending the forecast at once (see run_forward).
+    """
+    rows = state.execute(
+        f"SELECT request, url, domain_prefix, time_sent, max_parts FROM requests WHERE {QUERY_REQUESTS}",
+        (normalize_request(query),) * 2).fetchall()
+    state.execute(f"DELETE FROM requests WHERE {QUERY_REQUESTS}", (normalize_request(query),) * 2)
+    return set(rows)
+
+
+def save_sent_parts(state, url, parts):
+    """
+    Replace the parts last sent to that sailor.
+    """
+    now = time.time()
+    with state:
+        state.execute("DELETE FROM sent_parts WHERE url = ?", (url,))
+        state.executemany(
+            "INSERT INTO sent_parts VALUES (?, ?, ?, ?)",
+            [ (url, part_no, part, now) for part_no, part in enumerate(parts) ])
+
+
+def sent_parts(state, url, part_nos):
+    """
+    Return the given parts (or all if part_nos is empty) last sent to that
+    sailor, as a dict indexed by part number.
+    """
+    rows = state.execute("SELECT part_no, part FROM sent_parts WHERE url = ?", (url,)).fetchall()
+    return { part_no: part for part_no, part in rows if not part_nos or part_no in part_nos }
+
+
+def count_requests(state):
+    return state.execute("SELECT COUNT(*) FROM requests").fetchone()[0]
+
+
+def read_bigram_model(bigram_file):
+    if os.path.exists(bigram_file):
+        with open(bigram_file, 'r') as f:
+            try:
+                saved = json.load(f)
+                model = new_bigram_model()
+                model['good'] = set(saved['good'])
+                model['failures'] = saved['failures']
+                logging.debug(f"Reading {len(model['failures'])} failed parts from {bigram_file}")
+                return model
+            except (json.decoder.JSONDecodeError, KeyError):
+                print(f"CANNOT PARSE BIGRAM FILE {bigram_file}, STARTING FROM SCRATCH!", flush=True)
+    return new_bigram_model()
+
+
+def save_bigram_model(bigram_file, model):
+    # Other sends may be updating the model meanwhile:
+    with model['lock']:
+        logging.debug(f"Saving {len(model['failures'])} failed parts into {bigram_file}")
+        with open(bigram_file, 'w+') as f:
+            json.dump({ 'good': sorted(model['good']), 'failures': model['failures'] }, f, indent=2)
 
 
 def timeout_state(state):
-    # TODO
+    """
+    Forget the requests which answer never came, and the parts sent long ago.
+    """
+    with state:
+        expired = state.execute(
+            "DELETE FROM requests WHERE time_sent < ?", (time.time() - STATE_TTL,)).rowcount
+        state.execute("DELETE FROM sent_parts WHERE time_sent < ?", (time.time() - STATE_TTL,))
+    if expired > 0:
+        logging.warning(f"Forgot {expired} forecast requests older than {STATE_TTL}s")
     return state
 
 
@@ -273,10 +1438,11 @@ def main():
     parser.add_argument('-m', '--mail-conf', default='.mail-conf.json', help="JSON file with the mail server parameters")
     parser.add_argument('-l', '--long-delay', type=int, default=60, help="How long to sleep in between two mailbox checks when no weather forecast request is going on")
     parser.add_argument('-s', '--short-delay', type=int, default=5, help="How long to sleep in between two mailbox checks when some weather forecast requests are going on")
-    parser.add_argument('--state-file', help="JSON file where the internal state is saved", default=".state.json")
+    parser.add_argument('--state-file', help="SQLite file where the internal state is saved", default=".state.sqlite")
     parser.add_argument('-c', '--count', type=int, default=0, help="How many emails to handle before quitting (0: loop forever)")
     parser.add_argument('-d', '--debug', action='store_true', help="Verbose logs")
     parser.add_argument('--encode', help="Just encode this file and quit")
+    parser.add_argument('--idle', action='store_true', help="Wait for new mails with IMAP IDLE instead of polling the mailbox")
     args = parser.parse_args()
 
     level=logging.INFO
@@ -290,23 +1456,31 @@ def main():
     random.seed()
 
     if args.encode:
-        encode(args.encode, just_print)
+        encode(args.encode, just_print, version=mail_conf.get('format-version', 1), max_parts=mail_conf.get('max-parts'), stream=mail_conf.get('stream-encode', False))
         exit(0)
 
-    num_loops = 0
-    while(args.count <= 0 or num_loops < args.count):
-        num_loops += 1
-        state = read_state(args.state_file)
-        try:
-            state = check_mail(state, mail_conf)
-            state = timeout_state(state)
-            save_state(args.state_file, state)
-        except TimeoutError:
-            logging.warning("Timeout! Let's pause for a bit...\n")
-            time.sleep(500)
-        if len(state) > 0:
-            time.sleep(args.short_delay)
-        else:
-            time.sleep(args.long_delay)
+    state = open_state(args.state_file)
+    start_workers(state, args.state_file, mail_conf)
+    # When asked to stop, let the sends save where they are at:
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+        if args.idle and idle_loop(args, mail_conf, state):
+            exit(0)
+
+        num_loops = 0
+        while(args.count <= 0 or num_loops < args.count):
+            num_loops += 1
+            try:
+                state = check_mail(state, mail_conf)
+                state = timeout_state(state)
+            except TimeoutError:
+                logging.warning("Timeout! Let's pause for a bit...\n")
+                time.sleep(500)
+            if count_requests(state) > 0:
+                time.sleep(args.short_delay)
+            else:
+                time.sleep(args.long_delay)
+    finally:
+        stop_workers()
 
 main()